@@ -11,11 +11,69 @@ __all__     = [
 ]
 
 def main():
+	import os
 	import signal
-	from dispenser.dispenser import Dispenser
+	import argparse
+	from dispenser import metrics
+
+	parser = argparse.ArgumentParser(description = 'Token dispenser')
+	runner = parser.add_mutually_exclusive_group()
+	runner.add_argument('--realtime', action = 'store_true', help = 'run the motor, IR and tag reader in a separate real-time process')
+	runner.add_argument('--asyncio', action = 'store_true', help = 'run all jobs on an asyncio event loop')
+	parser.add_argument('--area', help = 'area to dispense for, read from /boot/area when not given')
+	parser.add_argument('--simulate', action = 'store_true', help = 'use a simulated rotor and tag reader instead of the GPIO pins')
+	parser.add_argument('--store', choices = ['firestore', 'memory'], default = 'firestore', help = 'where area and player documents live, memory runs without network')
+	parser.add_argument('--store-latency', type = float, nargs = '+', metavar = 'MS', help = 'latency of the memory store in ms, or a range of two')
+	parser.add_argument('--store-failure-rate', type = float, default = 0, help = 'fraction of commits to the memory store that fail')
+	parser.add_argument('--data-dir', help = 'directory of the journal and player cache, /var/lib/dispenser when not given')
+	parser.add_argument('--core', type = int, help = 'CPU core to pin the real-time process to')
+	parser.add_argument('--priority', type = int, help = 'SCHED_FIFO priority of the real-time process')
+	parser.add_argument('--rfid-irq', type = int, help = 'board pin of the RFID reader IRQ line, polls for tags when not given')
+	parser.add_argument('--rfid-poll', type = int, help = 'interval in ms to poll for tags without the IRQ line')
+	parser.add_argument('--metrics-port', type = int, default = metrics.PORT, help = 'port of the Prometheus metrics endpoint, 0 to disable')
+	args = parser.parse_args()
+
+	if args.simulate and args.realtime:
+		parser.error('--simulate can not be combined with --realtime')
+
+	if args.store_latency is not None and len(args.store_latency) > 2:
+		parser.error('--store-latency takes one or two values')
+
+	# Expose our metrics before anything can go wrong
+	if args.metrics_port:
+		metrics.serve(args.metrics_port)
 
 	# Perform all our setup
-	dispenser = Dispenser()
+	options = {
+		'area': args.area,
+		'rfid_irq': args.rfid_irq,
+		'rfid_poll': None if args.rfid_poll is None else args.rfid_poll * 1000000,
+	}
+	if args.simulate:
+		from dispenser.hardware import SimulatedHardware
+		options['hardware'] = SimulatedHardware()
+
+	if args.store == 'memory':
+		from dispenser.store import MemoryStore
+		latency = [ms / 1000 for ms in args.store_latency or [0]]
+		options['store'] = MemoryStore(
+			latency = latency[0] if len(latency) == 1 else tuple(latency),
+			failure_rate = args.store_failure_rate,
+		)
+
+	if args.data_dir is not None:
+		options['journal_path'] = os.path.join(args.data_dir, 'journal')
+		options['cache_path'] = os.path.join(args.data_dir, 'players.sqlite')
+
+	if args.realtime:
+		from dispenser.realtime.remote import RealtimeDispenser
+		dispenser = RealtimeDispenser(core = args.core, priority = args.priority, **options)
+	elif args.asyncio:
+		from dispenser.dispenser import AsyncDispenser
+		dispenser = AsyncDispenser(**options)
+	else:
+		from dispenser.dispenser import Dispenser
+		dispenser = Dispenser(**options)
 
 	# Add handlers for closing
 	signal.signal(signal.SIGINT, dispenser.close)
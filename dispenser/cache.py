@@ -0,0 +1,101 @@
+import os
+import sqlite3
+import logging
+import threading
+from dispenser.player import PlayerDetails
+
+logger = logging.getLogger(__name__)
+
+class PlayerCache():
+	def __init__(self, path : str):
+		os.makedirs(os.path.dirname(path) or '.', exist_ok = True)
+
+		self.lock = threading.Lock()
+		self.db = sqlite3.connect(path, isolation_level = None, check_same_thread = False)
+		self.db.execute('PRAGMA journal_mode = WAL')
+		self.db.execute('PRAGMA synchronous = NORMAL')
+		self.db.execute(
+			'CREATE TABLE IF NOT EXISTS players ('
+			'uid TEXT PRIMARY KEY, name TEXT, area TEXT, update_time TEXT)'
+		)
+
+		# Warm start from whatever we knew last time
+		self.players = {}
+		self.versions = {}
+		for uid, name, area, update_time in self.db.execute('SELECT uid, name, area, update_time FROM players'):
+			self.players[uid] = PlayerDetails(name, area)
+			self.versions[uid] = update_time
+
+		logger.info(f'Loaded {len(self.players)} cached players')
+
+	def __contains__(self, uid):
+		return uid in self.players
+
+	def __getitem__(self, uid):
+		return self.players[uid]
+
+	def __iter__(self):
+		return iter(self.players)
+
+	def __len__(self):
+		return len(self.players)
+
+	def get(self, uid, default = None):
+		return self.players.get(uid, default)
+
+	# Apply the changes of a players snapshot, only what changed touches the disk
+	def apply(self, changes):
+		upserts = []
+		deletes = []
+
+		with self.lock:
+			for change in changes:
+				uid = change.document.id
+				if change.type.name == 'REMOVED':
+					if uid in self.players:
+						del self.players[uid]
+						del self.versions[uid]
+						deletes.append((uid,))
+					continue
+
+				update_time = change.document.update_time.isoformat()
+				if self.versions.get(uid) == update_time:
+					continue
+
+				# Only the fields the dispenser actually uses are kept
+				data = change.document.to_dict()
+				player = PlayerDetails(data.get('name'), data.get('area'))
+				self.versions[uid] = update_time
+				if self.players.get(uid) == player:
+					continue
+
+				self.players[uid] = player
+				upserts.append((uid, player.name, player.area, update_time))
+
+			self.__write(upserts, deletes)
+
+	# A new listener does not report documents removed while we were away
+	def retain(self, uids):
+		with self.lock:
+			deletes = [(uid,) for uid in self.players.keys() - set(uids)]
+			for uid, in deletes:
+				del self.players[uid]
+				del self.versions[uid]
+
+			self.__write([], deletes)
+
+	def __write(self, upserts, deletes):
+		if len(upserts) == 0 and len(deletes) == 0:
+			return
+
+		try:
+			with self.db:
+				self.db.execute('BEGIN')
+				self.db.executemany('INSERT OR REPLACE INTO players VALUES (?, ?, ?, ?)', upserts)
+				self.db.executemany('DELETE FROM players WHERE uid = ?', deletes)
+		except sqlite3.Error:
+			logger.exception('Unable to write player cache')
+
+	def close(self):
+		with self.lock:
+			self.db.close()
@@ -0,0 +1,105 @@
+import logging
+from array import array
+from datetime import timedelta
+from dispenser.job import ns
+
+logger = logging.getLogger(__name__)
+
+# Fixed thresholds at full speed, used until we have seen enough of this unit
+T_DETECT_BIG = ns(timedelta(milliseconds=200))
+T_DETECT_SMALL = ns(timedelta(milliseconds=100))
+
+# Two groups of widths are only trusted when their means are this far apart, both
+# relative to each other and in standard deviations of the groups
+MIN_SEPARATION = 1.5
+MIN_SCORE = 2
+MIN_GROUP = 3
+
+def deviation(total, squares, n):
+	return max(0, squares / n - (total / n) ** 2) ** 0.5
+
+# Best split of sorted values into two groups (Otsu), returns the threshold or None
+def split(values):
+	n = len(values)
+	if n < 2 * MIN_GROUP:
+		return None
+
+	total = sum(values)
+	squares = sum(value * value for value in values)
+	best, threshold = 0, None
+	low, low_squares = 0, 0
+	for i in range(1, n):
+		low += values[i - 1]
+		low_squares += values[i - 1] * values[i - 1]
+		if i < MIN_GROUP or n - i < MIN_GROUP or values[i] == values[i - 1]:
+			continue
+
+		mean_low = low / i
+		mean_high = (total - low) / (n - i)
+		if mean_low <= 0 or mean_high < mean_low * MIN_SEPARATION:
+			continue
+
+		spread = deviation(low, low_squares, i) + deviation(total - low, squares - low_squares, n - i)
+		if mean_high - mean_low < spread * MIN_SCORE:
+			continue
+
+		# Between class variance, without the constant 1 / n ^ 2
+		variance = i * (n - i) * (mean_high - mean_low) ** 2
+		if variance > best:
+			best, threshold = variance, (values[i - 1] + values[i]) / 2
+	return threshold
+
+# Classifies IR pulses with thresholds learned from the last edges. Widths are
+# stored multiplied by the motor speed, so the thresholds hold at any speed.
+#
+# A long low pulse is the alignment marker, a long high pulse is an empty pocket.
+class CoinClassifier():
+	def __init__(self, full_speed : float = 1, size : int = 128):
+		if size & (size - 1):
+			raise ValueError('Buffer size must be a power of two')
+
+		self.full_speed = full_speed
+		self.size = size
+		self.mask = size - 1
+		self.ticks = array('q', bytes(8 * size))
+		self.widths = array('d', bytes(8 * size))
+		self.levels = array('b', bytes(size))
+		self.count = 0
+
+		# Learned thresholds per level, None until the two groups are clear
+		self.thresholds = [None, None]
+
+	def push(self, tick : int, level : int, width : int, speed : float):
+		if width <= 0 or speed <= 0:
+			return
+
+		i = self.count & self.mask
+		self.ticks[i] = tick
+		self.widths[i] = width * speed
+		self.levels[i] = level
+		self.count += 1
+
+	# Learn new thresholds, called once every half rotation
+	def update(self):
+		n = min(self.count, self.size)
+		for level in (0, 1):
+			values = sorted(self.widths[i] for i in range(n) if self.levels[i] == level)
+			self.thresholds[level] = split(values)
+
+	# Fixed threshold scaled from full speed to the current speed
+	def fallback(self, threshold : int, width : int, speed : float):
+		if speed <= 0:
+			return width > threshold
+		return width * speed > threshold * self.full_speed
+
+	# Width of a low pulse, the time the beam was not interrupted
+	def is_marker(self, width : int, speed : float):
+		if self.thresholds[0] is None or speed <= 0:
+			return self.fallback(T_DETECT_BIG, width, speed)
+		return width * speed > self.thresholds[0]
+
+	# Width of a high pulse, a long one means the pocket passing by is empty
+	def is_empty(self, width : int, speed : float):
+		if self.thresholds[1] is None or speed <= 0:
+			return self.fallback(T_DETECT_SMALL, width, speed)
+		return width * speed > self.thresholds[1]
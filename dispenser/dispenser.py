@@ -1,16 +1,18 @@
 #!/usr/bin/python3
-import time
-import pirc522
-import wiringpi
 import logging
 import socket
-import collections
 import dispenser
-from wiringpi import HIGH, LOW
 from functools import partial
-from datetime import timedelta, datetime, timezone
-from dispenser.job import Job, JobOnce, JobRunner
-from google.cloud import firestore
+from datetime import timedelta
+from dispenser.job import Job, JobRunner, AsyncJobRunner, ns
+from dispenser.rotor import Rotor, HIGH
+from dispenser.motor import CALIBRATIONS
+from dispenser.sync import Sync, Journal, CHECKIN, CHECKOUT, TICK, DISPENSE, EMPTY
+from dispenser.game import accrue, TickSchedule
+from dispenser.cache import PlayerCache
+from dispenser.player import Player, fingerprint, to_datetime
+from dispenser.metrics import SNAPSHOT_CALLBACK
+from dispenser.store import FirestoreStore, Increment, DELETE_FIELD, SERVER_TIMESTAMP
 
 logFormatter = '%(asctime)s - %(levelname)s - %(message)s'
 logging.basicConfig(
@@ -19,36 +21,16 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Load our area
-AREA = None
-with open('/boot/area', 'r') as f:
-	AREA = f.readline().strip(' \r\n')
+AREA_PATH = '/boot/area'
 
-if AREA is None:
-	logger.fatal('No area given')
-	exit(-1);
-logger.info(f'Dispenser v{dispenser.__version__} for area {AREA}')
+READ_GRACE = ns(timedelta(seconds=3))
 
-# PIN config
-LEDS = {
-	'holder': 17,
-	'reader': 24,
-	'ir': 4,
-}
-PIN_IR_RX = 7
-PIN_MOTOR = 18
-MOTOR_ON = 100
-MOTOR_REVERSE = 200
+JOURNAL_PATH = '/var/lib/dispenser/journal'
+CACHE_PATH = '/var/lib/dispenser/players.sqlite'
 
-# Motor on blue uses different algorithm for turning off...
-MOTOR_OFF = 0 if AREA == 'blue' else 150
-
-READ_GRACE = timedelta(seconds=3)
-
-T_DETECT_BIG = timedelta(milliseconds=200)
-T_DETECT_SMALL = timedelta(milliseconds=100)
-
-T_JAM = timedelta(seconds=2)
+def read_area(path = AREA_PATH):
+	with open(path, 'r') as f:
+		return f.readline().strip(' \r\n')
 
 def get_ip():
 	s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -62,67 +44,75 @@ def get_ip():
 		s.close()
 	return ip
 
-class Dispenser(JobRunner):
+class Dispenser(Rotor, JobRunner):
 	# All variables
-	is_calibrating = False
-	dispense_no = 0
-	current_dispense_no = 0
-	leading_edge_at = None
-	motor_speed = MOTOR_OFF
-	is_recovery = False
 	is_closed = False
-	previous_ir_state = 0
-	previous_edge_time = None
-	last_rotate_time = datetime.now(timezone.utc)
-	empty_count = 0
 
 	# Different watches
 	watch_area = None
 	watch_players = None
 	is_updating = False
 
-	# Empty list
-	is_coin_empty = False
-	coin_presences = None
-
-	def __init__(self, **kwargs):
+	def __init__(
+		self,
+		area : str = None,
+		hardware = None,
+		store = None,
+		rfid_irq : int = None,
+		rfid_poll : int = None,
+		journal_path : str = JOURNAL_PATH,
+		cache_path : str = CACHE_PATH,
+		**kwargs
+		):
+		# Load our area
+		self.area = read_area() if area is None else area
+		if not self.area:
+			raise ValueError('No area given')
+		logger.info(f'Dispenser v{dispenser.__version__} for area {self.area}')
+
+		self.hardware = hardware
+		self.rfid_irq = rfid_irq
+		if rfid_poll is not None:
+			self.rfid_poll = rfid_poll
+
+		# Until the area document tells us better
+		self.motor_calibration = dict(CALIBRATIONS.get(self.area, {}))
 
 		# Setup all required hardware
-		self.reader = pirc522.RFID(pin_irq = None, antenna_gain = 3)
-		wiringpi.wiringPiSetupGpio()
-
-		# Setup the motor
-		wiringpi.pinMode(PIN_MOTOR, wiringpi.GPIO.PWM_OUTPUT)
-		wiringpi.pwmSetMode(wiringpi.GPIO.PWM_MODE_MS)
-		wiringpi.pwmSetClock(192)
-		wiringpi.pwmSetRange(2000)
-
-		# Setup the LEDs
-		for name, pin in LEDS.items():
-			wiringpi.pinMode(pin, wiringpi.GPIO.OUTPUT)
-			wiringpi.digitalWrite(pin, LOW)
-
-		# Setup IR RX and IR TX
-		wiringpi.pinMode(PIN_IR_RX, wiringpi.GPIO.INPUT)
-		self.set_led('ir', HIGH)
-
-		self.set_led('reader', HIGH)
+		self.setup_hardware()
 
 		# Setup initial state
-		self.coin_presences = collections.deque(maxlen=6)
 		self.players = {}
-		self.player_details = {}
+		self.is_players_synced = False
+
+		# Tags are validated from disk until the players watch catches up
+		self.player_details = PlayerCache(cache_path)
+		self.ticks = TickSchedule()
+
+		# Last applied area snapshot, used to only apply what changed
+		self.area_versions = {}
+		self.area_update_time = None
 		self.game = {
 			'is_empty': False,
 		}
 
-		# Setup Firestore
-		self.db = firestore.Client.from_service_account_json('/boot/firebase-credentials.json')
-		self.area_ref = self.db.collection('areas').document(AREA)
-		self.player_ref = self.db.collection('players')
+		# Setup Firestore, or whatever store we were given
+		self.store = FirestoreStore() if store is None else store
+		self.area_ref = self.store.area(self.area)
+		self.player_ref = self.store.players()
+
+		# All writes go through the background sync so we never block on the network
+		self.sync = Sync(self.store)
+		self.sync.start()
 
-		# We set our version
-		self.area_ref.set({
+		# Replay whatever did not reach Firestore before we stopped
+		self.journal = Journal(journal_path)
+		self.journal_queued = set()
+		self.journal_replay()
+
+		# We set our version, we align on start anyway
+		self.area_resets = {'is_align'}
+		self.sync.set(self.area_ref, {
 			'version': dispenser.__version__,
 			'is_update': False,
 			'ip': get_ip(),
@@ -135,51 +125,65 @@ class Dispenser(JobRunner):
 		# Finally start alignment
 		self.align_rotor()
 
-	@Job(minutes = 1)
+	@Job(minutes = 1, executor = 'io')
 	def job_check_watch(self):
 		# Check if our watch is closed
 		if self.watch_area is None or self.watch_area._closed:
-			self.watch_area = self.area_ref.on_snapshot(self.on_area_update)
+			self.watch_area = self.area_ref.on_snapshot(self.threadsafe(self.on_area_update))
 			logger.warning('Restarting area watch')
 
+			# We probably reconnected, so retry anything that was dropped
+			self.journal_replay()
+
 		# Check if our watch is closed
 		if self.watch_players is None or self.watch_players._closed:
-			self.watch_players = self.player_ref.on_snapshot(self.on_players_update)
+			self.is_players_synced = False
+			self.watch_players = self.player_ref.on_snapshot(self.threadsafe(self.on_players_update))
 			logger.warning('Restarting players watch')
 
 	# Create a callback on_snapshot function to capture changes
+	@SNAPSHOT_CALLBACK.timed(callback = 'on_players_update')
 	def on_players_update(self, snapshot, changes, read_time):
 		try:
-			for change in changes:
-				if change.type.name == 'ADDED':
-					self.player_details[change.document.id] = change.document.to_dict()
-				elif change.type.name == 'MODIFIED':
-					self.player_details[change.document.id] = change.document.to_dict()
-				elif change.type.name == 'REMOVED':
-					del self.player_details[change.document.id]
+			self.player_details.apply(changes)
+
+			# The first snapshot of a watch is complete, so drop anything removed meanwhile
+			if not self.is_players_synced:
+				self.is_players_synced = True
+				self.player_details.retain(doc.id for doc in snapshot)
 		except Exception as e:
 			logger.exception('Exception in handling players update')
 
+	# Whether the area asks for something by setting flag, which we reset. Until
+	# the reset is committed snapshots still have it set, so those are ignored.
+	def area_request(self, data, flag):
+		if data.get(flag) != True:
+			self.area_resets.discard(flag)
+			return False
+
+		if flag in self.area_resets:
+			return False
+
+		self.area_resets.add(flag)
+		self.sync.set(self.area_ref, {
+			flag: False,
+		}, merge = True)
+		return True
+
 	# Create a callback on_snapshot function to capture changes
+	@SNAPSHOT_CALLBACK.timed(callback = 'on_area_update')
 	def on_area_update(self, snapshot, changes, read_time):
 		try:
 			for doc in snapshot:
 				data = doc.to_dict()
 
-				# Check for full shutdown
-				if 'is_align' in data and data['is_align'] == True:
-					self.area_ref.set({
-						'is_align': False,
-					}, merge = True)
-
+				# Check for alignment
+				if self.area_request(data, 'is_align'):
 					self.align_rotor()
-					return
 
 				# Check for full shutdown
-				if 'is_shutdown' in data and data['is_shutdown'] == True:
-					self.area_ref.set({
-						'is_shutdown': False,
-					}, merge = True)
+				if self.area_request(data, 'is_shutdown'):
+					self.sync.close()
 
 					shutdown()
 					return
@@ -196,6 +200,13 @@ class Dispenser(JobRunner):
 					# we should handle that signal and restart gracefully :)
 					return
 
+				# Calibration of our motor
+				if isinstance(data.get('motor'), dict) and data['motor'] != self.motor_calibration:
+					logger.info(f'Motor calibration {data["motor"]}')
+					calibration = dict(data['motor'])
+					self.configure_motor(calibration)
+					self.motor_calibration = calibration
+
 				# Update our area
 				if 'tick_seconds' not in data:
 					data['tick_seconds'] = 300
@@ -206,37 +217,63 @@ class Dispenser(JobRunner):
 				if 'limit' not in data:
 					data['limit'] = 25
 
-				self.game['tick_seconds'] = timedelta(seconds=data['tick_seconds'])
+				# With lazy accrual credit is only written at checkout and every checkpoint
+				if 'accrual' not in data:
+					data['accrual'] = 'eager'
+
+				if 'checkpoint_seconds' not in data:
+					data['checkpoint_seconds'] = 900
+
+				game = dict(self.game)
+				self.game['tick_seconds'] = ns(timedelta(seconds=data['tick_seconds']))
 				self.game['tick_amount'] = data['tick_amount']
 				self.game['limit'] = data['limit']
+				self.game['accrual'] = data['accrual']
+				self.game['checkpoint_seconds'] = ns(timedelta(seconds=data['checkpoint_seconds']))
 				# self.job_game_tick.job.update(seconds = data['tick_seconds'] // 4)
 
 				# logger.info(f'Game info, limit: {self.game["limit"]}, tick_seconds: {self.game["tick_seconds"]}, tick_amount: {self.game["tick_amount"]}')
 
-				remote_uids = set()
+				# Changing the game moves every deadline
+				if game != self.game:
+					self.ticks.clear()
+					for uid in list(self.players.keys()):
+						self.player_schedule(uid)
 
-				# Update our players
+				# Nothing changed for the players since the last applied snapshot
+				if doc.update_time is not None and doc.update_time == self.area_update_time:
+					continue
+				self.area_update_time = doc.update_time
+
+				remote_players = {}
 				if 'players' in data and isinstance(data['players'], dict):
-					for uid, player in data['players'].items():
-						remote_uids.add(uid)
-
-						# Make sure dictionary exists
-						if uid not in self.players:
-							tick = datetime.now(timezone.utc)
-							self.players[uid] = {
-								'last_read': tick,
-								'tick': tick,
-								'credit': 0,
-								'present': False,
-							}
-
-						# Update any changed value
-						self.players[uid].update(player)
+					remote_players = data['players']
+
+				# Update our players
+				for uid, player in remote_players.items():
+					# Skip players that did not change since the last snapshot
+					version = fingerprint(player)
+					if version is not None and self.area_versions.get(uid) == version:
+						continue
+					self.area_versions[uid] = version
+
+					# Make sure player exists
+					if uid not in self.players:
+						tick = self.clock.time()
+						self.players[uid] = Player(tick, tick)
+
+					# Only apply real changes, our own writes come back as values we already have
+					if self.players[uid].update_remote(player):
+						self.player_schedule(uid)
 
 				# Delete any player that is not on the remote
-				for uid in set(self.players.keys()) - remote_uids:
+				for uid in self.players.keys() - remote_players.keys():
 					logger.info(f'Removing local {uid}')
 					del self.players[uid]
+					self.ticks.cancel(uid)
+
+				for uid in self.area_versions.keys() - remote_players.keys():
+					del self.area_versions[uid]
 
 		except Exception as e:
 			logger.exception('Exception in handling area update')
@@ -248,176 +285,93 @@ class Dispenser(JobRunner):
 		self.stop()
 
 		logger.info('Closing dispenser')
+		self.close_hardware()
 
-		# Turnoff LEDs
-		for name, pin in LEDS.items():
-			wiringpi.digitalWrite(pin, wiringpi.GPIO.LOW)
-
-		# Turnoff motor
-		wiringpi.pinMode(PIN_MOTOR, wiringpi.GPIO.OUTPUT)
+		# Stop listening, the store may outlive us
+		for watch in (self.watch_area, self.watch_players):
+			if watch is not None:
+				watch.unsubscribe()
 
-		self.reader.cleanup()
+		# Flush any pending writes
+		self.sync.close()
+		self.journal.close()
+		self.player_details.close()
 
 	def __del__(self):
 		self.close()
 
 
-	def align_rotor(self):
-		logger.info('Aligning rotor')
-		self.is_calibrating = True
-		self.previous_edge_time = None
-		self.last_rotate_time = datetime.now(timezone.utc)
-		self.set_motor(MOTOR_ON)
-
-
-	def recovery_done(self):
-		if self.dispense_no > 0:
-			# Dispense the same amount
-			# But jump forward in the amount currently dispensed ;)
-			c = self.current_dispense_no
-			self.dispense(self.dispense_no)
-			self.current_dispense_no = c
-		elif self.is_calibrating:
-			self.align_rotor()
-
-		self.is_recovery = False
-
-	@Job(seconds = 1, align = True)
-	def job_check_rotor_recovery(self):
-		# If we are calibrating, recovering or not dispensing, we are not doing anything
-		if self.motor_speed == MOTOR_OFF:
-			return
-
-		if (datetime.now(timezone.utc) - self.last_rotate_time) > T_JAM:
-			# Recovery mode
-			self.is_recovery = True
-			self.set_motor(MOTOR_REVERSE)
-			logger.error(f'Jam after {self.current_dispense_no} coins, recovering...')
-			JobOnce(self.recovery_done, seconds = 0.5)
-
-	@Job(milliseconds = 4, align = True)
-	def job_check_rotor(self):
-		# We only check if we are aligning or dispensing
-		if self.dispense_no <= 0 and not self.is_calibrating and not self.is_recovery:
-			return
-
-		# Initialize
-		if self.previous_edge_time is None:
-			self.previous_edge_time = datetime.now(timezone.utc)
-
-		ir_state = self.get_ir()
-
-		# Detect raising edge
-		if self.previous_ir_state == 0 and ir_state == 1:
-			elapsed = (datetime.now(timezone.utc) - self.previous_edge_time)
-			# logger.warn(f'Raising edge {elapsed}')
-
-			self.previous_ir_state = 1
-			self.previous_edge_time = datetime.now(timezone.utc)
-
-			# Check for our alignment marker
-			if elapsed > T_DETECT_BIG:
-				# self.coin_presences.append()
-				self.on_half_rotation(not self.is_coin_empty)
-				self.is_coin_empty = False
-
-		# Detect trailing edge
-		elif self.previous_ir_state == 1 and ir_state == 0:
-			elapsed = (datetime.now(timezone.utc) - self.previous_edge_time)
-			# logger.warn(f'Falling edge {elapsed}')
-
-			self.previous_ir_state = 0
-			self.previous_edge_time = datetime.now(timezone.utc)
-
-			# If elapsed is in the slow window, the next coin will be empty
-			if elapsed > T_DETECT_SMALL:
-				self.is_coin_empty = True
-
-
-
-	def on_half_rotation(self, has_coin):
-		logger.info(f'Half rotation and coin presence is {has_coin}')
-
-		self.last_rotate_time = datetime.now(timezone.utc)
-
-		if self.is_calibrating:
-			self.is_calibrating = False
-			self.set_motor(MOTOR_OFF)
-			return
-
-		# If we are dispensing
-		if self.dispense_no > 0:
-			really_empty = False
-			if has_coin:
-				self.empty_count = 0
-			else:
-				self.empty_count += 1
-
-			# Normally, this would be in has_coin, but has_coin algorithm is currently
-			# not reliably enough...
-			self.current_dispense_no += 1
-
-			logger.info(f'Dispensed {self.current_dispense_no:d}')
-
-			# self.empty_count >= 3 or
-			if self.current_dispense_no >= self.dispense_no:
-				self.dispense_done(self.current_dispense_no)
-
-
-	@Job(seconds = 15)
+	# Players are credited for the time since their last tick and every due
+	# player is popped at once, so one late run makes up for the missed ones
+	@Job(seconds = 15, overrun = 'coalesce')
 	def job_game_tick(self):
-		tick = datetime.now(timezone.utc)
+		tick = self.clock.time()
 
 		# logger.info('Main game tick')
-		updates = {}
-		for uid, player in self.players.items():
-			# Skip players that are not present
-			if player['present'] != True:
+		# Only players whose tick is due are processed
+		for uid in self.ticks.pop(tick):
+			# Skip players that are gone or not present
+			if uid not in self.players or self.players[uid].present != True:
 				continue
 
-			# We limit the credits to [0, limit]
-			new_credit = max(0, min(player['credit'] + self.game['tick_amount'], self.game['limit']))
-
-			# If there is no change, or if we have already more (and positive tick rate), continue
-			if player['credit'] == new_credit or (self.game['tick_amount'] > 0 and player['credit'] > new_credit):
-				continue
-
-			# Check for update
-			if tick > player['tick'] + self.game['tick_seconds']:
+			if self.player_accrue(uid, tick) != 0:
 				logger.info(f'Give money to {uid}')
 
-				# Make sure we keep their checkin alignment
-				while tick > player['tick'] + self.game['tick_seconds']:
-					player['tick'] += self.game['tick_seconds']
-
-				# Update player
-				updates[uid] = {
-					'credit': firestore.Increment(new_credit - player['credit']),
-					'tick': player['tick'],
-				}
-
-		# Update everything in one go
-		if len(updates) > 0:
-			self.area_ref.set({
-				'players': updates,
-			}, merge = True)
-
-
-	@Job(milliseconds = 500)
-	def job_read_tag(self):
-		# Do not read tags if we are going
-		if self.motor_speed != MOTOR_OFF:
-			return
+			self.player_schedule(uid)
 
-		# Read the UID
-		uid = self.reader.read_id(True)
-		if uid is None:
+	# Schedule the next moment a player is due for credit
+	def player_schedule(self, uid):
+		player = self.players.get(uid)
+		if (
+			player is None or
+			player.present != True or
+			'tick_seconds' not in self.game or
+			self.game['tick_amount'] == 0 or
+			(self.game['tick_amount'] > 0 and player.credit >= self.game['limit']) or
+			(self.game['tick_amount'] < 0 and player.credit <= 0)
+			):
+			self.ticks.cancel(uid)
 			return
 
-		tick = datetime.now(timezone.utc)
-
-		# We only use string UIDS padded to 14 digits
-		uid = f'{uid:014X}'
+		# Lazy accrual only writes once per checkpoint
+		if self.game['accrual'] == 'lazy':
+			self.ticks.schedule(uid, player.tick + self.game['checkpoint_seconds'])
+		else:
+			self.ticks.schedule(uid, player.tick + self.game['tick_seconds'])
+
+	# Credit of a player including anything accrued since their last tick
+	def player_credit(self, uid, tick = None):
+		player = self.players[uid]
+
+		# Nothing accrues before we know the game
+		if 'tick_seconds' not in self.game:
+			return player.credit, player.tick
+
+		return accrue(
+			player.credit,
+			player.tick,
+			self.clock.time() if tick is None else tick,
+			self.game['tick_seconds'],
+			self.game['tick_amount'],
+			self.game['limit'],
+		)
+
+	# Writes any accrued credit and returns how much that was
+	def player_accrue(self, uid, tick = None):
+		player = self.players[uid]
+		credit, player_tick = self.player_credit(uid, tick)
+		if credit == player.credit:
+			return 0
+
+		amount = credit - player.credit
+		player.credit = credit
+		player.tick = player_tick
+		self.journal_event(TICK, uid, value = amount, at = player.tick)
+		return amount
+
+
+	def on_tag(self, uid : str):
+		tick = self.clock.time()
 
 		# Check if this UID is a valid player
 		if uid not in self.player_details:
@@ -425,21 +379,22 @@ class Dispenser(JobRunner):
 			self.set_led_flash('reader', 4, 0.1, HIGH)
 			return
 
+		# Wait with anything else until this player got paid
+		if self.is_dispensing(uid):
+			logger.info(f'User {uid} is still being paid out')
+			return
+
 		# We got a TAG
 		if not uid in self.players:
-			self.players[uid] = {
-				'last_read': tick - READ_GRACE,
-				'tick': tick,
-				'credit': 0,
-				'present': False,
-			}
+			self.players[uid] = Player(tick - READ_GRACE, tick)
 
 		# Never read to quickly
-		if tick >= self.players[uid]['last_read'] + READ_GRACE:
-			self.players[uid]['last_read'] = tick
-			self.players[uid]['present'] = not self.players[uid]['present']
+		player = self.players[uid]
+		if tick >= player.last_read + READ_GRACE:
+			player.last_read = tick
+			player.present = not player.present
 
-			if self.players[uid]['present']:
+			if player.present:
 				self.player_checkin(uid)
 			else:
 				self.player_checkout(uid)
@@ -453,36 +408,15 @@ class Dispenser(JobRunner):
 		self.set_led_flash('reader', 10, 0.05, HIGH)
 
 		# Checkout this person if in another area
+		area = ''
 		if (
-			'area' in self.player_details[uid] and
-			self.player_details[uid]['area'] is not None and
-			self.player_details[uid]['area'] != AREA
+			self.player_details[uid].area is not None and
+			self.player_details[uid].area != self.area
 			):
-			logger.info(f'Checking player out at {self.player_details[uid]["area"]}')
-			self.db.collection('areas').document(self.player_details[uid]['area']).set({
-				'players': {
-					uid: {
-						'present': False,
-					}
-				}
-			}, merge = True)
+			logger.info(f'Checking player out at {self.player_details[uid].area}')
+			area = self.player_details[uid].area
 
-		# Update player and area
-		self.player_ref.document(uid).set({
-			'area': AREA,
-		}, merge = True)
-
-		self.area_ref.set({
-			'players': {
-				uid: {
-					'present': True,
-					'name': self.player_details[uid]['name'],
-					'checkin': firestore.SERVER_TIMESTAMP,
-					'tick': firestore.SERVER_TIMESTAMP,
-					'credit': firestore.Increment(0),
-				}
-			}
-		}, merge = True)
+		self.journal_event(CHECKIN, uid, text = area)
 
 
 	def player_checkout(self, uid):
@@ -491,113 +425,149 @@ class Dispenser(JobRunner):
 			logger.error('Checking out player that does not exists...')
 			return
 
-		logger.info(f'Checkout for {uid} with credit {self.players[uid]["credit"]}')
+		# Make sure everything accrued until now is written before paying out
+		self.player_accrue(uid)
+
+		logger.info(f'Checkout for {uid} with credit {self.players[uid].credit}')
 
 		# Flag the player locally to not present to avoid giving more money
-		self.players[uid]['present'] = False
-		self.current_uid = uid
+		self.players[uid].present = False
+		self.ticks.cancel(uid)
 
-		if self.players[uid]['credit'] <= 0:
+		if self.players[uid].credit <= 0:
 			self.set_led_flash('reader', 10, 0.05, HIGH)
 
-			# We trigger dispense done of zero, this will nicely handle player checkout
-			self.dispense_done(0)
+			# Nothing to dispense, this will nicely handle player checkout
+			self.on_dispense_done(0, 0, uid)
 		else:
-			self.dispense(self.players[uid]['credit'])
+			# The credit is final now, so it is fine to wait for a running payout
+			self.dispense(self.players[uid].credit, uid)
 
 
-	def set_motor(self, speed: int):
-		self.motor_speed = speed
-
-		# # We reverse a bit
-		# if speed == MOTOR_OFF:
-		# 	wiringpi.pwmWrite(PIN_MOTOR, MOTOR_REVERSE)
-		# 	time.sleep(0.3)
-
-		wiringpi.pwmWrite(PIN_MOTOR, speed)
-
-	def get_ir(self):
-		# We read 10 time with 1 us sleep and get the one that happens the most
-		states = []
-		for _ in range(0, 10):
-			states.append(wiringpi.digitalRead(PIN_IR_RX))
-			time.sleep(1 / (1000 * 1000))
-		return HIGH if states.count(HIGH) > states.count(LOW) else LOW
-
-	def set_led(self, led : str, value):
-		if led not in LEDS:
-			raise ValueError(f'LED {led} does not exist')
-
-		logger.debug(f'Setting LED {led} to {value}')
-		wiringpi.digitalWrite(LEDS[led], value)
-
-	def dispense(self, amount : int):
-		logger.info(f'Dispensing {amount:d}')
-		if amount <= 0:
-			return
-
-		self.dispense_no = amount
-		self.current_dispense_no = 0
-		self.previous_edge_time = None
-		self.last_rotate_time = datetime.now(timezone.utc)
-
-		# Start the motor
-		self.set_motor(MOTOR_ON)
-		self.set_led('reader', LOW)
-		self.set_led('holder', HIGH)
-
-	def dispense_done(self, amount):
-		# Cleanup and turnoff the LED
-		self.set_motor(MOTOR_OFF)
-		if amount > 0:
-			JobOnce(lambda: self.set_led('holder', LOW), seconds = 3)
-			JobOnce(lambda: self.set_led('reader', HIGH), seconds = 3)
-
+	def on_dispense_done(self, amount : int, requested : int, uid : str = None):
 		# Notify server of departure
 		# Raise a flag that we are empty
-		self.game['is_empty'] = amount != self.dispense_no
+		self.game['is_empty'] = amount != requested
 
-		# Check if we are empty, if so, we reduce credit
+		# Check if we are empty, if so, we only reduce credit
 		if self.game['is_empty']:
 			logger.info(f'We are empty, we only dispensed {amount} coins')
-			# Only reduce
-			self.area_ref.set({
-				'paid': firestore.Increment(amount),
-				'is_empty': self.game['is_empty'],
-				'players': {
-					self.current_uid: {
-						'present': False,
-						'credit': firestore.Increment(-amount),
-					}
-				}
-			}, merge = True)
 		else:
 			logger.info(f'Dispense done, gave {amount} coins')
-			self.area_ref.update({
-				'paid': firestore.Increment(amount),
-				'is_empty': self.game['is_empty'],
-				f'players.{self.current_uid}': firestore.DELETE_FIELD,
-			})
-			del self.players[self.current_uid]
-
-		# Finally, remove player from area
-		self.player_ref.document(self.current_uid).set({
-			'area': None,
-			AREA: firestore.Increment(amount),
-		}, merge = True)
-
-		# Our flag that we are not dispensing
-		self.current_uid = None
-		self.dispense_no = 0
+			self.players.pop(uid, None)
+
+		self.journal_event(
+			DISPENSE if amount > 0 else CHECKOUT,
+			uid,
+			value = amount,
+			flags = EMPTY if self.game['is_empty'] else 0,
+		)
+
+	def journal_event(self, type : int, uid : str, **kwargs):
+		self.journal_sync(self.journal.append(type, uid, **kwargs))
+
+	def journal_sync(self, entry):
+		self.journal_queued.add(entry['seq'])
+		self.sync.event(
+			self.area_ref.collection('journal').document(entry['key']),
+			{
+				'type': entry['type'],
+				'uid': entry['uid'],
+				'value': entry['value'],
+				'at': SERVER_TIMESTAMP,
+			},
+			self.journal_writes(entry),
+			partial(self.on_journal_synced, entry['seq']),
+		)
+
+	def on_journal_synced(self, seq, is_applied):
+		self.journal_queued.discard(seq)
+		if is_applied:
+			self.journal.ack(seq)
+
+	def journal_replay(self):
+		for entry in self.journal.pending():
+			if entry['seq'] not in self.journal_queued:
+				self.journal_sync(entry)
+
+	# Firestore writes belonging to a journal entry, these are also used for replays
+	def journal_writes(self, entry):
+		uid = entry['uid']
+		amount = entry['value']
+		writes = []
+
+		if entry['type'] == CHECKIN:
+			# Checkout this person if in another area
+			if entry['text']:
+				writes.append((self.store.area(entry['text']), 'set', {
+					'players': {
+						uid: {
+							'present': False,
+						}
+					}
+				}))
+
+			# Update player and area
+			writes.append((self.player_ref.document(uid), 'set', {
+				'area': self.area,
+			}))
+
+			player = {
+				'present': True,
+				'checkin': SERVER_TIMESTAMP,
+				'tick': SERVER_TIMESTAMP,
+				'credit': Increment(0),
+			}
+			if uid in self.player_details and self.player_details[uid].name is not None:
+				player['name'] = self.player_details[uid].name
 
-	def set_led_flash(self, led : str, amount : int, seconds : int, end_value : int, value : int = LOW):
-		self.set_led(led, value)
-		v = HIGH if value == LOW else LOW
+			writes.append((self.area_ref, 'set', {
+				'players': {
+					uid: player,
+				}
+			}))
 
-		if amount > 0:
-			JobOnce(partial(self.set_led_flash, led, amount - 1, seconds, end_value, v), seconds = seconds)
-		else:
-			JobOnce(partial(self.set_led, led, end_value), seconds = seconds)
+		elif entry['type'] == TICK:
+			writes.append((self.area_ref, 'set', {
+				'players': {
+					uid: {
+						'credit': Increment(amount),
+						'tick': to_datetime(entry['time']),
+					}
+				}
+			}))
+
+		elif entry['type'] in (CHECKOUT, DISPENSE):
+			if entry['flags'] & EMPTY:
+				# Only reduce
+				writes.append((self.area_ref, 'set', {
+					'paid': Increment(amount),
+					'is_empty': True,
+					'players': {
+						uid: {
+							'present': False,
+							'credit': Increment(-amount),
+						}
+					}
+				}))
+			else:
+				writes.append((self.area_ref, 'update', {
+					'paid': Increment(amount),
+					'is_empty': False,
+					f'players.{uid}': DELETE_FIELD,
+				}))
+
+			# Finally, remove player from area
+			writes.append((self.player_ref.document(uid), 'set', {
+				'area': None,
+				self.area: Increment(amount),
+			}))
+
+		return writes
+
+# Runs all jobs and snapshot callbacks on a single asyncio event loop
+class AsyncDispenser(Dispenser, AsyncJobRunner):
+	pass
 
 def shutdown():
 	import subprocess
@@ -0,0 +1,62 @@
+import heapq
+import threading
+
+def accrue(credit, tick, now, tick_seconds, tick_amount, limit):
+	# Number of complete periods, a tick exactly on the boundary is not complete yet
+	periods = -((tick - now) // tick_seconds) - 1
+	if periods <= 0:
+		return credit, tick
+
+	# We limit the credits to [0, limit]
+	new_credit = max(0, min(credit + periods * tick_amount, limit))
+
+	# If we have already more (and positive tick rate), we keep it
+	if tick_amount > 0 and credit > new_credit:
+		new_credit = credit
+
+	# Make sure we keep their checkin alignment
+	return new_credit, tick + periods * tick_seconds
+
+class TickSchedule():
+	# Heap of the next moment each player is due for credit. Rescheduling leaves the
+	# old entry behind, which is skipped because it no longer matches due.
+	def __init__(self):
+		self.heap = []
+		self.due = {}
+		self.lock = threading.Lock()
+
+	def __len__(self):
+		return len(self.due)
+
+	def schedule(self, uid, due):
+		with self.lock:
+			if self.due.get(uid) == due:
+				return
+
+			self.due[uid] = due
+			heapq.heappush(self.heap, (due, uid))
+
+			# Do not let stale entries pile up
+			if len(self.heap) > 2 * len(self.due) + 64:
+				self.heap = [(due, uid) for uid, due in self.due.items()]
+				heapq.heapify(self.heap)
+
+	def cancel(self, uid):
+		with self.lock:
+			self.due.pop(uid, None)
+
+	def clear(self):
+		with self.lock:
+			self.heap = []
+			self.due = {}
+
+	# All players that are due before now, they are removed from the schedule
+	def pop(self, now):
+		uids = []
+		with self.lock:
+			while len(self.heap) > 0 and self.heap[0][0] < now:
+				due, uid = heapq.heappop(self.heap)
+				if self.due.get(uid) == due:
+					del self.due[uid]
+					uids.append(uid)
+		return uids
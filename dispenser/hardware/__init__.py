@@ -0,0 +1,4 @@
+from dispenser.hardware.edge import EdgeRing, EdgeCapture, SoftwareEdgeCapture, WiringPiEdgeCapture
+from dispenser.hardware.rfid import T_TAG_POLL, TagDetector, PollingTagDetector, IrqTagDetector
+from dispenser.hardware.hardware import HIGH, LOW, LEDS, Hardware, PiHardware
+from dispenser.hardware.simulator import RotorModel, SimulatedHardware
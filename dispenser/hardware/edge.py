@@ -0,0 +1,160 @@
+import sys
+from array import array
+from datetime import timedelta
+from dispenser.job import get_clock, ns
+
+# Pulses shorter than this are considered noise on the IR receiver
+T_GLITCH = ns(timedelta(microseconds=200))
+
+# Seconds a thread may hold the GIL while the ISR thread waits for it
+SWITCH_INTERVAL = 0.0005
+
+class EdgeRing():
+	# Single producer, single consumer ring buffer. The producer only writes head
+	# and the consumer only writes tail, so neither side needs a lock.
+	def __init__(self, size : int = 256):
+		if size & (size - 1):
+			raise ValueError('Ring size must be a power of two')
+
+		self.size = size
+		self.mask = size - 1
+		self.times = array('q', bytes(8 * size))
+		self.levels = array('b', bytes(size))
+		self.head = 0
+		self.tail = 0
+		self.overruns = 0
+
+	def __len__(self):
+		return self.head - self.tail
+
+	def push(self, tick : int, level : int) -> bool:
+		if self.head - self.tail >= self.size:
+			self.overruns += 1
+			return False
+
+		i = self.head & self.mask
+		self.times[i] = tick
+		self.levels[i] = level
+
+		# Publish only after the slot is written
+		self.head += 1
+		return True
+
+	def pop(self):
+		if self.tail == self.head:
+			return None
+
+		i = self.tail & self.mask
+		edge = (self.times[i], self.levels[i])
+		self.tail += 1
+		return edge
+
+class EdgeCapture():
+	def __init__(self, size : int = 256, glitch : int = T_GLITCH):
+		self.ring = EdgeRing(size)
+		self.glitch = glitch
+
+		# Producer side, last level pushed into the ring
+		self.level = None
+
+		# Consumer side, edge waiting for its glitch window and last delivered level
+		self.pending = None
+		self.delivered = None
+
+	@property
+	def clock(self):
+		return get_clock()
+
+	def start(self):
+		pass
+
+	def stop(self):
+		pass
+
+	# Polling backends sample here, interrupt backends do not need it
+	def poll(self):
+		pass
+
+	# Producer, called for every observed level change
+	def on_edge(self, level : int, tick : int = None):
+		if level == self.level:
+			return
+
+		self.level = level
+		self.ring.push(self.clock.now() if tick is None else tick, level)
+
+	# Consumer, yields (tick, level) for every stable edge
+	def drain(self, now : int = None):
+		if now is None:
+			now = self.clock.now()
+
+		while True:
+			edge = self.ring.pop()
+			if edge is None:
+				break
+
+			# Two edges within the glitch window cancel each other out
+			if self.pending is not None:
+				if edge[0] - self.pending[0] < self.glitch:
+					self.pending = None
+					continue
+				yield from self.__deliver(self.pending)
+
+			self.pending = edge
+
+		# The last edge is only stable once its glitch window passed
+		if self.pending is not None and now - self.pending[0] >= self.glitch:
+			yield from self.__deliver(self.pending)
+			self.pending = None
+
+	def __deliver(self, edge):
+		if edge[1] != self.delivered:
+			self.delivered = edge[1]
+			yield edge
+
+class SoftwareEdgeCapture(EdgeCapture):
+	# Fallback without interrupts, samples the given read function when polled.
+	# Without a read function, edges can only be injected using on_edge.
+	def __init__(self, read = None, **kwargs):
+		super().__init__(**kwargs)
+		self.read = read
+
+	def poll(self):
+		if self.read is not None:
+			self.on_edge(self.read())
+
+# WiringPi calls the ISR from its own thread, which first has to take the GIL.
+# The timestamp is taken after that, so an edge is late by as long as another
+# thread holds on to it. For Python code the switch interval (5 ms by default)
+# bounds that, so we lower it while capturing. C code holding the GIL can still
+# delay an edge longer.
+class WiringPiEdgeCapture(EdgeCapture):
+	def __init__(self, pin : int, **kwargs):
+		super().__init__(**kwargs)
+		self.pin = pin
+		self.is_running = False
+		self.wiringpi = None
+		self.switch_interval = None
+
+	def start(self):
+		import wiringpi
+
+		self.wiringpi = wiringpi
+		self.is_running = True
+		self.switch_interval = sys.getswitchinterval()
+		sys.setswitchinterval(min(self.switch_interval, SWITCH_INTERVAL))
+		self.on_edge(wiringpi.digitalRead(self.pin))
+		wiringpi.wiringPiISR(self.pin, wiringpi.INT_EDGE_BOTH, self.__isr)
+
+	def stop(self):
+		# WiringPi cannot unregister an ISR, so we just ignore it from now on
+		self.is_running = False
+		if self.switch_interval is not None:
+			sys.setswitchinterval(self.switch_interval)
+			self.switch_interval = None
+
+	def __isr(self):
+		# Timestamp first, reading the level takes time as well
+		tick = self.clock.now()
+		if self.is_running:
+			self.on_edge(self.wiringpi.digitalRead(self.pin), tick)
@@ -0,0 +1,116 @@
+import time
+import logging
+from dispenser.hardware.edge import SoftwareEdgeCapture, WiringPiEdgeCapture
+from dispenser.hardware.rfid import PollingTagDetector, IrqTagDetector
+
+logger = logging.getLogger(__name__)
+
+HIGH = 1
+LOW = 0
+
+# PIN config, BCM numbering
+LEDS = {
+	'holder': 17,
+	'reader': 24,
+	'ir': 4,
+}
+PIN_IR_RX = 7
+PIN_MOTOR = 18
+
+# Everything the rotor needs from the board: motor PWM, LEDs, the IR receiver and the tag reader
+class Hardware():
+	def setup(self):
+		pass
+
+	def close(self):
+		pass
+
+	def set_motor(self, pwm : int):
+		raise NotImplementedError
+
+	def set_led(self, led : str, value : int):
+		raise NotImplementedError
+
+	def read_ir(self) -> int:
+		raise NotImplementedError
+
+	# Started edge capture of the IR receiver
+	def edge_capture(self):
+		return SoftwareEdgeCapture(self.read_ir)
+
+	# Started tag detector, using the IRQ line when given
+	def tag_detector(self, irq : int = None, poll : int = None):
+		raise NotImplementedError
+
+# Raspberry Pi with the servo on hardware PWM and an RC522 reader
+class PiHardware(Hardware):
+	def __init__(self):
+		import wiringpi
+
+		self.wiringpi = wiringpi
+		self.reader = None
+
+	def setup(self):
+		wiringpi = self.wiringpi
+		wiringpi.wiringPiSetupGpio()
+
+		# Setup the motor
+		wiringpi.pinMode(PIN_MOTOR, wiringpi.GPIO.PWM_OUTPUT)
+		wiringpi.pwmSetMode(wiringpi.GPIO.PWM_MODE_MS)
+		wiringpi.pwmSetClock(192)
+		wiringpi.pwmSetRange(2000)
+
+		# Setup the LEDs
+		for name, pin in LEDS.items():
+			wiringpi.pinMode(pin, wiringpi.GPIO.OUTPUT)
+			wiringpi.digitalWrite(pin, LOW)
+
+		# Setup IR RX
+		wiringpi.pinMode(PIN_IR_RX, wiringpi.GPIO.INPUT)
+
+	def close(self):
+		# Turnoff motor
+		self.wiringpi.pinMode(PIN_MOTOR, self.wiringpi.GPIO.OUTPUT)
+
+		if self.reader is not None:
+			self.reader.cleanup()
+
+	def set_motor(self, pwm : int):
+		self.wiringpi.pwmWrite(PIN_MOTOR, pwm)
+
+	def set_led(self, led : str, value : int):
+		self.wiringpi.digitalWrite(LEDS[led], value)
+
+	def read_ir(self):
+		# We read 10 time with 1 us sleep and get the one that happens the most
+		states = []
+		for _ in range(0, 10):
+			states.append(self.wiringpi.digitalRead(PIN_IR_RX))
+			time.sleep(1 / (1000 * 1000))
+		return HIGH if states.count(HIGH) > states.count(LOW) else LOW
+
+	def edge_capture(self):
+		# Capture IR edges using interrupts and fallback to polling
+		edges = WiringPiEdgeCapture(PIN_IR_RX)
+		try:
+			edges.start()
+			return edges
+		except Exception:
+			logger.exception('Unable to capture IR edges using interrupts, polling instead')
+			return super().edge_capture()
+
+	def tag_detector(self, irq : int = None, poll : int = None):
+		import pirc522
+
+		# Detect tags using the IRQ line and fallback to polling
+		if irq is not None:
+			try:
+				self.reader = pirc522.RFID(pin_irq = irq, antenna_gain = 3)
+				tags = IrqTagDetector(self.reader)
+				tags.start()
+				return tags
+			except Exception:
+				logger.exception('Unable to detect tags using interrupts, polling instead')
+
+		self.reader = pirc522.RFID(pin_irq = None, antenna_gain = 3)
+		return PollingTagDetector(self.reader) if poll is None else PollingTagDetector(self.reader, poll)
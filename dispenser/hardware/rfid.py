@@ -0,0 +1,96 @@
+import logging
+import threading
+import collections
+from datetime import timedelta
+from dispenser.job import get_clock, ns
+from dispenser.metrics import RFID_READ
+
+logger = logging.getLogger(__name__)
+
+# Polling interval for boards without the IRQ wire
+T_TAG_POLL = ns(timedelta(milliseconds=100))
+
+# Do not read a tag again within this time after a read, it is most likely still on the reader
+T_TAG_HOLDOFF = ns(timedelta(milliseconds=500))
+
+class TagDetector():
+	def __init__(self, reader, holdoff : int = T_TAG_HOLDOFF):
+		self.reader = reader
+		self.holdoff = holdoff
+		self.uids = collections.deque(maxlen=16)
+
+	@property
+	def clock(self):
+		return get_clock()
+
+	def start(self):
+		pass
+
+	def stop(self):
+		pass
+
+	# Polling backends read here, interrupt backends do not need it
+	def poll(self):
+		pass
+
+	def read(self):
+		with RFID_READ.labels().time():
+			uid = self.reader.read_id(True)
+
+		if uid is not None:
+			self.uids.append(uid)
+		return uid
+
+	def clear(self):
+		self.uids.clear()
+
+	# Yields the UID of every tag read since the last drain
+	def drain(self):
+		while self.uids:
+			yield self.uids.popleft()
+
+class PollingTagDetector(TagDetector):
+	def __init__(self, reader, interval : int = T_TAG_POLL, **kwargs):
+		super().__init__(reader, **kwargs)
+		self.interval = interval
+		self.next_read = 0
+
+	def poll(self):
+		tick = self.clock.now()
+		if tick < self.next_read:
+			return
+
+		uid = self.read()
+		self.next_read = tick + (self.interval if uid is None else max(self.interval, self.holdoff))
+
+# Waits on the RC522 IRQ pin for a card and only then reads its UID. The reader is
+# only used from our thread, so nobody else may talk to it once started.
+class IrqTagDetector(TagDetector):
+	def __init__(self, reader, timeout : float = 1, **kwargs):
+		super().__init__(reader, **kwargs)
+		self.timeout = timeout
+		self.stopped = threading.Event()
+		self.thread = None
+
+	def start(self):
+		self.stopped.clear()
+		self.thread = threading.Thread(target=self.run, name='rfid', daemon=True)
+		self.thread.start()
+
+	def stop(self):
+		self.stopped.set()
+		if self.thread is not None:
+			self.thread.join(self.timeout * 2)
+
+	def run(self):
+		while not self.stopped.is_set():
+			try:
+				# Times out now and then so we can stop. It does not tell us whether a
+				# tag is there, so always try to read one.
+				self.reader.wait_for_tag(self.timeout)
+
+				if self.read() is not None:
+					self.stopped.wait(self.holdoff / 1e9)
+			except Exception:
+				logger.exception('Exception in reading tag')
+				self.stopped.wait(self.timeout)
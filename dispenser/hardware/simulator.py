@@ -0,0 +1,290 @@
+import math
+import time
+import heapq
+import random
+import logging
+import threading
+from datetime import timedelta
+from dispenser.job import get_clock, ns
+from dispenser.hardware.edge import EdgeCapture
+from dispenser.hardware.rfid import PollingTagDetector, IrqTagDetector
+from dispenser.hardware.hardware import Hardware, LEDS, LOW
+
+logger = logging.getLogger(__name__)
+
+# IR level and length (as part of a half rotation) of every segment of a pocket
+POCKET_COIN = ((0, 0.5), (1, 0.1), (0, 0.3), (1, 0.1))
+POCKET_EMPTY = ((0, 0.5), (1, 0.3), (0, 0.1), (1, 0.1))
+
+# Integration step of the rotor
+T_STEP = ns(timedelta(milliseconds=1))
+
+# Tags stay on the reader this long when tapped
+T_TAP = ns(timedelta(milliseconds=400))
+
+# How often a simulated IRQ line looks for a tag, in seconds of real time
+T_IRQ_CHECK = 0.005
+
+# A servo driven rotor. Its speed follows the PWM with a first order lag, the
+# position is in half rotations and every half rotation passes one pocket.
+class RotorModel():
+	def __init__(
+		self,
+		coins : int = 1000,
+		half_rotation : float = 0.5,
+		neutral : int = 150,
+		full : int = 100,
+		lag : float = 0.05,
+		jitter : float = 0.02,
+		seed : int = None,
+		):
+		self.coins = coins
+		self.rate = 1 / half_rotation
+		self.neutral = neutral
+		self.full = full
+		self.lag = lag
+		self.jitter = jitter
+		self.random = random.Random(seed)
+
+		self.pwm = 0
+		self.speed = 0
+		self.position = 0.0
+		self.pockets = {0: POCKET_COIN}
+		self.noise = 1.0
+		self.is_jammed = False
+		self.reversed = 0.0
+		self.dispensed = 0
+		self.dropped = 0
+		self.jams = 0
+		self.time = None
+
+		# Scheduled (time, sequence, function) events
+		self.events = []
+		self.sequence = 0
+
+		self.listeners = []
+
+	def schedule(self, at : int, f):
+		self.sequence += 1
+		heapq.heappush(self.events, (at, self.sequence, f))
+
+	# Speed the PWM drives us to, in half rotations per second
+	def target(self):
+		if self.pwm == 0:
+			return 0
+		return self.rate * max(-1.2, min(1.2, (self.neutral - self.pwm) / (self.neutral - self.full))) * self.noise
+
+	def pocket(self, index : int):
+		if index not in self.pockets:
+			# A pocket takes a coin when it passes the hopper
+			if self.coins > 0:
+				self.coins -= 1
+				self.pockets[index] = POCKET_COIN
+			else:
+				self.pockets[index] = POCKET_EMPTY
+		return self.pockets[index]
+
+	def level_at(self, position : float):
+		index = math.floor(position)
+		fraction = position - index
+		for level, length in self.pocket(index):
+			if fraction < length:
+				return level
+			fraction -= length
+		return self.pocket(index)[-1][0]
+
+	@property
+	def level(self):
+		return self.level_at(self.position)
+
+	# Positions of all segment boundaries between a and b
+	def boundaries(self, a : float, b : float):
+		index = math.floor(min(a, b))
+		while index <= max(a, b):
+			boundary = index
+			for level, length in self.pocket(index):
+				if min(a, b) < boundary <= max(a, b):
+					yield boundary
+				boundary += length
+			index += 1
+
+	def advance(self, now : int):
+		if self.time is None:
+			self.time = now
+
+		while self.time < now:
+			# Run scheduled events on time
+			if self.events and self.events[0][0] <= self.time:
+				heapq.heappop(self.events)[2]()
+				continue
+
+			step = min(T_STEP, now - self.time)
+			if self.events:
+				step = max(1, min(step, self.events[0][0] - self.time))
+			self.step(step)
+
+		while self.events and self.events[0][0] <= now:
+			heapq.heappop(self.events)[2]()
+
+	def step(self, dt : int):
+		seconds = dt / 1e9
+		self.speed += (self.target() - self.speed) * (1 - math.exp(-seconds / self.lag))
+
+		# A jam blocks forward motion until we reversed a bit
+		speed = self.speed
+		if self.is_jammed:
+			if speed < 0:
+				self.reversed -= speed * seconds
+				if self.reversed > 0.05:
+					self.is_jammed = False
+			speed = min(0, speed)
+
+		start = self.position
+		self.position += speed * seconds
+
+		# Report every edge at the moment we crossed it
+		boundaries = sorted(self.boundaries(start, self.position), reverse = self.position < start)
+		previous = self.level_at(start)
+		for boundary in boundaries:
+			level = self.level_at(boundary + (1e-9 if self.position > start else -1e-9))
+			if level == previous:
+				continue
+			previous = level
+
+			tick = self.time + int(dt * (boundary - start) / (self.position - start))
+			for listener in self.listeners:
+				listener(level, tick)
+
+		# A new pocket passed, so its coin dropped. Pockets brought back by
+		# reversing are empty already.
+		if math.floor(self.position) > math.floor(start):
+			for index in range(max(self.dropped, math.floor(start)), math.floor(self.position)):
+				if self.pocket(index) is POCKET_COIN:
+					self.dispensed += 1
+			self.dropped = max(self.dropped, math.floor(self.position))
+			self.noise = 1 + self.random.uniform(-self.jitter, self.jitter)
+
+		self.time += dt
+
+	def jam(self):
+		self.jams += 1
+		self.is_jammed = True
+		self.reversed = 0.0
+
+class SimulatedEdgeCapture(EdgeCapture):
+	def __init__(self, model : RotorModel, **kwargs):
+		super().__init__(**kwargs)
+		self.model = model
+
+	def start(self):
+		self.model.listeners.append(self.on_edge)
+		self.on_edge(self.model.level)
+
+	def stop(self):
+		if self.on_edge in self.model.listeners:
+			self.model.listeners.remove(self.on_edge)
+
+	def poll(self):
+		self.model.advance(self.clock.now())
+
+class SimulatedReader():
+	def __init__(self, pin_irq : int = None):
+		self.pin_irq = pin_irq
+		self.taps = []
+		self.reads = 0
+		self.condition = threading.Condition()
+
+	@property
+	def clock(self):
+		return get_clock()
+
+	def tap(self, uid : str, at : int = None, duration : int = T_TAP):
+		at = self.clock.now() if at is None else at
+		with self.condition:
+			self.taps.append((at, at + duration, uid))
+			self.condition.notify_all()
+
+	def present(self):
+		now = self.clock.now()
+		with self.condition:
+			self.taps = [tap for tap in self.taps if tap[1] > now]
+			for start, end, uid in self.taps:
+				if start <= now:
+					return uid
+		return None
+
+	# Like pi-rc522 this returns nothing, also when it timed out
+	def wait_for_tag(self, timeout : float = None):
+		if self.pin_irq is None:
+			raise ValueError('Reader has no IRQ pin')
+
+		deadline = None if timeout is None else time.monotonic() + timeout
+		with self.condition:
+			while self.present() is None:
+				if deadline is not None and time.monotonic() >= deadline:
+					return
+				self.condition.wait(T_IRQ_CHECK)
+
+	def read_id(self, as_number = False):
+		self.reads += 1
+		uid = self.present()
+		if uid is None:
+			return None
+		return int(uid, 16) if as_number else uid
+
+	def cleanup(self):
+		pass
+
+# Simulated board. Script it with tap, jam and empty, times are clock times in ns.
+# Tags are polled, or detected with the simulated IRQ line when irq is given.
+class SimulatedHardware(Hardware):
+	def __init__(self, model : RotorModel = None):
+		self.model = model or RotorModel()
+		self.reader = SimulatedReader()
+		self.leds = {name: LOW for name in LEDS}
+
+	@property
+	def clock(self):
+		return get_clock()
+
+	def set_motor(self, pwm : int):
+		self.model.advance(self.clock.now())
+		self.model.pwm = pwm
+
+	def set_led(self, led : str, value : int):
+		self.leds[led] = value
+
+	def read_ir(self):
+		self.model.advance(self.clock.now())
+		return self.model.level
+
+	def edge_capture(self):
+		edges = SimulatedEdgeCapture(self.model)
+		edges.start()
+		return edges
+
+	def tag_detector(self, irq : int = None, poll : int = None):
+		if irq is not None:
+			self.reader.pin_irq = irq
+			tags = IrqTagDetector(self.reader)
+			tags.start()
+			return tags
+
+		self.reader.pin_irq = None
+		return PollingTagDetector(self.reader) if poll is None else PollingTagDetector(self.reader, poll)
+
+	def tap(self, uid : str, at : int = None, duration : int = T_TAP):
+		self.reader.tap(uid, at, duration)
+
+	def jam(self, at : int = None):
+		self.model.schedule(self.clock.now() if at is None else at, self.model.jam)
+
+	def empty(self, at : int = None):
+		def empty():
+			self.model.coins = 0
+		self.model.schedule(self.clock.now() if at is None else at, empty)
+
+	def fill(self, coins : int, at : int = None):
+		def fill():
+			self.model.coins += coins
+		self.model.schedule(self.clock.now() if at is None else at, fill)
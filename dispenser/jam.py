@@ -0,0 +1,82 @@
+import logging
+import statistics
+import collections
+from dispenser.metrics import JAMS
+
+logger = logging.getLogger(__name__)
+
+# Rotations needed before we trust the window
+MIN_SAMPLES = 3
+
+# Predicts jams from a rolling window of half rotation periods and edge widths. All
+# timings are stored multiplied by the motor speed they were measured at, so the
+# speed changes of the motor controller do not look like a slowdown.
+class JamDetector():
+	def __init__(self, params : dict, size : int = 16):
+		self.params = params
+		self.periods = collections.deque(maxlen=size)
+		self.widths = collections.deque(maxlen=size * 4)
+		self.expected_period = None
+		self.longest_width = None
+		self.is_jammed = False
+
+		# Statistics to tune the thresholds per unit
+		self.stats = collections.Counter()
+		self.history = collections.deque(maxlen=32)
+
+	def on_half_rotation(self, period : int, speed : float):
+		if self.is_jammed:
+			self.is_jammed = False
+			self.stats['recovered'] += 1
+
+		if period <= 0 or speed <= 0:
+			return
+
+		self.periods.append(period * speed)
+		self.expected_period = statistics.median(self.periods)
+
+	def on_edge(self, width : int, speed : float):
+		if width <= 0 or speed <= 0:
+			return
+
+		self.widths.append(width * speed)
+		self.longest_width = max(self.widths)
+
+	# Returns (reason, ratio) when a jam is coming, ratio is how far over the expected time we are
+	def check(self, since_rotation : int, since_edge : int, speed : float):
+		if speed <= 0 or len(self.periods) < MIN_SAMPLES:
+			return None
+
+		# The current half rotation takes much longer than usual
+		expected = self.expected_period / speed
+		if since_rotation * 100 > expected * self.params['jam_slowdown_pct']:
+			return 'slowdown', since_rotation / expected
+
+		# No edge for longer than the longest gap of a half rotation
+		if self.longest_width is not None:
+			longest = self.longest_width / speed
+			if since_edge * 100 > longest * self.params['jam_stall_pct']:
+				return 'stall', since_edge / longest
+
+		# Every recent half rotation was slower than the one before
+		recent = list(self.periods)[-MIN_SAMPLES:]
+		if all(a < b for a, b in zip(recent, recent[1:])) and recent[-1] * 100 > self.expected_period * self.params['jam_trend_pct']:
+			return 'trend', recent[-1] / self.expected_period
+
+		return None
+
+	def on_jam(self, reason : str, ratio : float = None, coins : int = 0):
+		self.is_jammed = True
+		self.stats[reason] += 1
+		self.history.append({
+			'reason': reason,
+			'ratio': ratio,
+			'coins': coins,
+			'expected_period': self.expected_period,
+		})
+		JAMS.labels(reason = reason).inc()
+
+		# A trend is gone after recovering, start over
+		if reason == 'trend':
+			self.periods.clear()
+			self.expected_period = None
@@ -1 +1,3 @@
 from dispenser.job.job import Job, JobOnce, JobRunner
+from dispenser.job.clock import Clock, MonotonicClock, VirtualClock, get_clock, set_clock, ns
+from dispenser.job.aio import AsyncJobRunner
@@ -0,0 +1,145 @@
+import asyncio
+import functools
+import threading
+from dispenser.job import job as registry
+from dispenser.job.job import JobRunner
+
+# Runs the same @Job and JobOnce declarations on an asyncio event loop. Every job
+# gets its own loop.call_at timer, so nothing is polled. Jobs can be coroutine
+# functions, these run as tasks and never overlap with themselves.
+#
+# The event loop keeps its own monotonic time, so this runner only works with
+# the MonotonicClock
+class AsyncJobRunner(JobRunner):
+	event_loop = None
+	__thread = None
+	__stopped = None
+	__handles = None
+	__tasks = None
+
+	def stop(self):
+		# An attached instance only takes its jobs off the runner
+		if self.job_runner is not self:
+			return super().stop()
+
+		self.is_running = False
+
+		if self.event_loop is not None and not self.event_loop.is_closed():
+			self.event_loop.call_soon_threadsafe(self.__stop)
+
+	def __stop(self):
+		if self.__stopped is not None:
+			self.__stopped.set()
+
+	def __is_loop_thread(self):
+		return threading.get_ident() == self.__thread
+
+	# Hand calls from other threads, like on_snapshot, to the event loop
+	def threadsafe(self, callback):
+		if self.job_runner is not self:
+			return self.job_runner.threadsafe(callback)
+
+		@functools.wraps(callback)
+		def wrapper(*args, **kwargs):
+			if self.event_loop is None or self.__is_loop_thread():
+				return callback(*args, **kwargs)
+			self.event_loop.call_soon_threadsafe(functools.partial(callback, *args, **kwargs))
+		return wrapper
+
+	# Event loop time (in seconds) of a clock time (in ns)
+	def __when(self, tock):
+		return self.event_loop.time() + (tock - self.clock.now()) / 1e9
+
+	def schedule(self, job):
+		if self.event_loop is None:
+			return
+
+		if not self.__is_loop_thread():
+			self.event_loop.call_soon_threadsafe(self.schedule, job)
+			return
+
+		if job['disabled'] or not self._is_own(job):
+			return
+
+		job['entry'] += 1
+
+		# Initialize begin time for a new job
+		if job['tock'] is None:
+			job['tock'] = self._first_tock(job, self.clock.now())
+
+		handle = self.__handles.pop(id(job), None)
+		if handle is not None:
+			handle.cancel()
+		self.__handles[id(job)] = self.event_loop.call_at(self.__when(job['tock']), self.__call, job)
+
+	def __call(self, job):
+		self.__handles.pop(id(job), None)
+		if job['disabled'] or not self.is_running:
+			return
+
+		entry = job['entry']
+
+		if not self._begin(job, self.clock.now()):
+			pass
+		elif asyncio.iscoroutinefunction(job['function']):
+			job['running'] = True
+			self.__track(job, self.event_loop.create_task(self.__invoke_async(job)))
+		elif job['executor'] is not None:
+			job['running'] = True
+			self.__track(job, self.event_loop.run_in_executor(self._pool(job['executor']), self._invoke, job))
+		else:
+			self._invoke(job)
+
+		self._end(job, entry)
+
+	async def __invoke_async(self, job):
+		with self._measure(job):
+			return await self._target(job)()
+
+	def __track(self, job, future):
+		self.__tasks.add(future)
+		future.add_done_callback(self.__tasks.discard)
+		future.add_done_callback(functools.partial(self._finish, job))
+
+	# Run until stopped or, when given, until the clock reaches until (in ns)
+	def loop(self, until : int = None):
+		try:
+			asyncio.run(self.run(until))
+		except KeyboardInterrupt:
+			pass
+
+	async def run(self, until : int = None):
+		self.event_loop = asyncio.get_running_loop()
+		self.__thread = threading.get_ident()
+		self.__stopped = asyncio.Event()
+		self.__handles = {}
+		self.__tasks = set()
+
+		# Bind our own jobs, subscribe for new jobs and schedule everything that is already known
+		self.attach()
+		registry.runners.append(self)
+		for job in self._registered():
+			self.schedule(job)
+
+		if until is not None:
+			self.event_loop.call_at(self.__when(until), self.__stop)
+
+		try:
+			if self.is_running:
+				await self.__stopped.wait()
+		finally:
+			registry.runners[:] = [runner for runner in registry.runners if runner is not self]
+
+			# Cancel all timers and running jobs
+			for handle in self.__handles.values():
+				handle.cancel()
+			self.__handles.clear()
+
+			for task in list(self.__tasks):
+				task.cancel()
+			if self.__tasks:
+				await asyncio.gather(*self.__tasks, return_exceptions = True)
+
+			self._shutdown()
+			self._prune()
+			self.event_loop = None
@@ -0,0 +1,208 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+import collections
+from functools import partial
+from datetime import datetime, timedelta, timezone
+import dispenser
+from dispenser.job import job as registry
+from dispenser.job.job import Job, JobOnce, JobRunner
+from dispenser.job.aio import AsyncJobRunner
+from dispenser.job.clock import get_clock, ns
+from dispenser.metrics import HistogramValue
+
+SCHEDULERS = ('heap', 'poll', 'asyncio')
+
+# Records the lateness of every call by the kind of job
+class Recorder():
+	def _advance(self, job, tick):
+		should_run = super()._advance(job, tick)
+		kind = job.get('kind', 'other')
+		if kind not in self.lateness:
+			self.lateness[kind] = HistogramValue()
+		self.lateness[kind].record(job['late'])
+		return should_run
+
+class BenchmarkRunner(Recorder, JobRunner):
+	def __init__(self, scheduler : str):
+		self.scheduler = scheduler
+		self.lateness = {}
+
+class AsyncBenchmarkRunner(Recorder, AsyncJobRunner):
+	def __init__(self):
+		self.lateness = {}
+
+def create_runner(scheduler : str):
+	if scheduler == 'asyncio':
+		return AsyncBenchmarkRunner()
+	return BenchmarkRunner(scheduler)
+
+# The jobs of a run, counts calls per kind and disables everything when done
+class Mix():
+	def __init__(self):
+		self.runs = collections.Counter()
+		self.jobs = []
+
+	def add(self, kind : str, f, **kwargs):
+		job = Job(**kwargs)
+		job.job['kind'] = kind
+		job(partial(self.call, kind, f))
+		self.jobs.append(job.job)
+
+	def once(self, kind : str, f, **kwargs):
+		job = JobOnce(partial(self.call, kind, f), **kwargs)
+		job.job['kind'] = kind
+		self.jobs.append(job.job)
+
+	def call(self, kind : str, f):
+		self.runs[kind] += 1
+		if f is not None:
+			f()
+
+	def flash(self, seconds : float):
+		# Like Rotor.set_led_flash every toggle schedules the next one, but it never ends
+		self.once('flash', partial(self.flash, seconds), seconds = seconds)
+
+	def close(self):
+		for job in self.jobs:
+			job['disabled'] = True
+		registry.jobs[:] = [job for job in registry.jobs if not job['disabled']]
+
+def busy(seconds : float):
+	end = time.perf_counter() + seconds
+	while time.perf_counter() < end:
+		pass
+
+def run(scheduler : str, args, capacity : bool = False):
+	mix = Mix()
+	runner = create_runner(scheduler)
+
+	if capacity:
+		# No-op jobs that are always due, so the runner does nothing but dispatch
+		for _ in range(args.capacity_jobs):
+			mix.add('capacity', None, microseconds = 1)
+		duration = args.capacity_duration
+	else:
+		for _ in range(args.aligned):
+			mix.add('aligned', None, milliseconds = args.aligned_ms, align = True)
+		for _ in range(args.unaligned):
+			mix.add('unaligned', None, milliseconds = args.unaligned_ms)
+		for _ in range(args.slow):
+			mix.add('slow', partial(busy, args.slow_ms / 1000), milliseconds = args.slow_interval_ms)
+		for _ in range(args.io):
+			mix.add('io', partial(time.sleep, args.io_ms / 1000), milliseconds = args.io_interval_ms, executor = 'io')
+		for _ in range(args.flashes):
+			mix.flash(args.flash_ms / 1000)
+		duration = args.duration
+
+	clock = get_clock()
+	wall, cpu = time.perf_counter(), time.process_time()
+	try:
+		runner.loop(clock.now() + ns(timedelta(seconds = duration)))
+	finally:
+		mix.close()
+	wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+
+	runs = sum(mix.runs.values())
+	return {
+		'scheduler': scheduler,
+		'wall_s': wall,
+		'cpu_per_wall_s': cpu / wall,
+		'runs': dict(mix.runs),
+		'jobs_per_s': runs / wall,
+		'missed': sum(job['missed'] for job in mix.jobs),
+		'lateness_us': {
+			kind: {
+				'count': histogram.count,
+				**{f'p{q * 100:g}': histogram.quantile(q) / 1e3 for q in (0.5, 0.9, 0.99, 0.999)},
+				'max': histogram.max / 1e3,
+			}
+			for kind, histogram in sorted(runner.lateness.items())
+		},
+	}
+
+# Where these results come from, so they can be compared across commits and boards
+def describe():
+	commit = None
+	try:
+		commit = subprocess.run(
+			['git', 'rev-parse', 'HEAD'],
+			cwd = os.path.dirname(os.path.abspath(__file__)),
+			capture_output = True,
+			text = True,
+			timeout = 5,
+		).stdout.strip() or None
+	except (OSError, subprocess.SubprocessError):
+		pass
+
+	model = None
+	try:
+		with open('/proc/device-tree/model', 'r') as f:
+			model = f.read().strip('\0\n ')
+	except OSError:
+		pass
+
+	return {
+		'version': dispenser.__version__,
+		'commit': commit,
+		'model': model or platform.machine(),
+		'python': platform.python_version(),
+		'platform': platform.platform(),
+		'cpus': os.cpu_count(),
+		'time': datetime.now(timezone.utc).isoformat(),
+	}
+
+def print_result(result : dict):
+	print(f'{result["scheduler"]:<8} {result["jobs_per_s"]:>10.0f} jobs/s {result["cpu_per_wall_s"]:>6.1%} CPU {result["missed"]:>6} missed')
+	for kind, lateness in result['lateness_us'].items():
+		print(f'  {kind:<10} {lateness["count"]:>8} calls, late p50 {lateness["p50"]:>8.0f} us, p99 {lateness["p99"]:>8.0f} us, p99.9 {lateness["p99.9"]:>8.0f} us, max {lateness["max"]:>8.0f} us')
+
+def main():
+	parser = argparse.ArgumentParser(description = 'Benchmark the job runners with a configurable mix of jobs')
+	parser.add_argument('--scheduler', choices = SCHEDULERS, action = 'append', help = 'runner to benchmark, may be repeated, all when not given')
+	parser.add_argument('--duration', type = float, default = 10, help = 'seconds to run the mix for every runner')
+	parser.add_argument('--aligned', type = int, default = 1, help = 'aligned periodic jobs, like job_check_rotor')
+	parser.add_argument('--aligned-ms', type = int, default = 4, help = 'interval of the aligned jobs')
+	parser.add_argument('--unaligned', type = int, default = 2, help = 'unaligned periodic jobs, like job_read_tag')
+	parser.add_argument('--unaligned-ms', type = int, default = 20, help = 'interval of the unaligned jobs')
+	parser.add_argument('--slow', type = int, default = 1, help = 'jobs that keep the runner busy')
+	parser.add_argument('--slow-ms', type = float, default = 5, help = 'time a slow job keeps the CPU busy')
+	parser.add_argument('--slow-interval-ms', type = int, default = 100, help = 'interval of the slow jobs')
+	parser.add_argument('--io', type = int, default = 2, help = 'jobs on the io pool that wait on the network')
+	parser.add_argument('--io-ms', type = float, default = 200, help = 'time an io job waits')
+	parser.add_argument('--io-interval-ms', type = int, default = 1000, help = 'interval of the io jobs')
+	parser.add_argument('--flashes', type = int, default = 10, help = 'LED flashes running at the same time, each a chain of JobOnce timers')
+	parser.add_argument('--flash-ms', type = int, default = 50, help = 'time between the toggles of a flash')
+	parser.add_argument('--capacity-jobs', type = int, default = 100, help = 'always due jobs to measure the capacity with, 0 to skip')
+	parser.add_argument('--capacity-duration', type = float, default = 3, help = 'seconds to measure the capacity for every runner')
+	parser.add_argument('--json', help = 'write the results as JSON to this file')
+	args = parser.parse_args()
+
+	results = {
+		'machine': describe(),
+		'config': vars(args),
+		'mix': [],
+		'capacity': [],
+	}
+	for scheduler in args.scheduler or SCHEDULERS:
+		result = run(scheduler, args)
+		print_result(result)
+		results['mix'].append(result)
+
+		if args.capacity_jobs:
+			result = run(scheduler, args, capacity = True)
+			print(f'{"":<8} {result["jobs_per_s"]:>10.0f} jobs/s capacity with {args.capacity_jobs} jobs')
+			results['capacity'].append(result)
+
+	if args.json:
+		with open(args.json, 'w') as f:
+			json.dump(results, f, indent = 2)
+
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,83 @@
+import time
+import threading
+from datetime import timedelta, datetime, timezone
+
+def ns(delta: timedelta) -> int:
+	return (delta.days * 86400 + delta.seconds) * 1000000000 + delta.microseconds * 1000
+
+class Clock():
+	# Nanoseconds on a monotonic scale, only differences are meaningful
+	def now(self) -> int:
+		raise NotImplementedError
+
+	# Nanoseconds since the epoch, used for timestamps shared with the outside world
+	def time(self) -> int:
+		raise NotImplementedError
+
+	def utcnow(self) -> datetime:
+		return datetime.fromtimestamp(self.time() / 1000000000, timezone.utc)
+
+	# Wait on the condition (which must be held) until notified or until we reach
+	# the deadline given on the now() scale
+	def wait(self, condition, deadline : int = None):
+		raise NotImplementedError
+
+	def sleep(self, seconds : float):
+		raise NotImplementedError
+
+class MonotonicClock(Clock):
+	def now(self) -> int:
+		return time.monotonic_ns()
+
+	def time(self) -> int:
+		return time.time_ns()
+
+	def wait(self, condition, deadline : int = None):
+		if deadline is None:
+			return condition.wait()
+		return condition.wait(max(0, deadline - time.monotonic_ns()) / 1000000000)
+
+	def sleep(self, seconds : float):
+		time.sleep(seconds)
+
+class VirtualClock(Clock):
+	def __init__(self, start : int = 0, epoch : int = None):
+		self.ticks = start
+		self.epoch = time.time_ns() - start if epoch is None else epoch
+		self.lock = threading.Lock()
+
+	def now(self) -> int:
+		return self.ticks
+
+	def time(self) -> int:
+		return self.epoch + self.ticks
+
+	def advance(self, delta : int):
+		self.advance_to(self.ticks + delta)
+
+	def advance_to(self, deadline : int):
+		# Time never goes backwards, even with multiple threads advancing
+		with self.lock:
+			if deadline > self.ticks:
+				self.ticks = deadline
+
+	def wait(self, condition, deadline : int = None):
+		# Without a deadline only another thread can wake us up
+		if deadline is None:
+			return condition.wait()
+
+		# Otherwise we jump straight to the deadline
+		self.advance_to(deadline)
+		return False
+
+	def sleep(self, seconds : float):
+		self.advance(int(seconds * 1000000000))
+
+clock = MonotonicClock()
+
+def get_clock() -> Clock:
+	return clock
+
+def set_clock(new_clock : Clock):
+	global clock
+	clock = new_clock
@@ -1,43 +1,132 @@
-import time
+import heapq
+import contextlib
 import random
 import types
 import functools
-from datetime import timedelta, datetime
+import logging
+import threading
+import collections
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from dispenser.job.clock import get_clock, ns
+from dispenser import metrics
 
+logger = logging.getLogger(__name__)
+
+# Jobs that any runner may run, like lambdas and partials that do not tell us
+# their runner. Jobs declared on a class are bound to every instance instead,
+# see JobRunner.attach
 jobs = []
 
+# Runners that are waiting on new jobs, see register
+runners = []
+
+# What to do with deadlines that passed while the runner was busy
+#  skip:            drop a run that is a full interval late and wait for the next deadline
+#  coalesce:        run once and continue with the next deadline (default)
+#  catch_up:        run once for every missed deadline, at most max_catch_up times
+#  run_immediately: run once and start a new interval from now on
+OVERRUN_POLICIES = ('skip', 'coalesce', 'catch_up', 'run_immediately')
+
+# Arguments that together make the interval of a job
+INTERVAL_ARGS = ('days', 'seconds', 'microseconds', 'milliseconds', 'minutes', 'hours', 'weeks')
+
 def is_lambda_function(obj):
 	return isinstance(obj, types.LambdaType) and obj.__name__ == "<lambda>"
 
+def register(job):
+	job['is_global'] = True
+	jobs.append(job)
+
+	# Wake up any sleeping runner so it can schedule the new job
+	for runner in runners:
+		runner.schedule(job)
+
+# Runner instance a function belongs to, partials are unwrapped
+def resolve(f):
+	while isinstance(f, functools.partial):
+		f = f.func
+
+	instance = getattr(f, '__self__', None)
+	return instance if isinstance(instance, JobRunner) else None
+
+# Name of the function behind partials and bound methods, it labels the metrics
+# so it may not differ per call
+def job_name(f):
+	while isinstance(f, functools.partial):
+		f = f.func
+
+	f = getattr(f, '__func__', f)
+	return getattr(f, '__qualname__', None) or type(f).__qualname__
+
+# Jobs declared on a class and its bases, a method overridden without @Job has no job
+def declarations(cls):
+	seen = set()
+	for klass in cls.__mro__:
+		for name, f in vars(klass).items():
+			if name in seen:
+				continue
+			seen.add(name)
+
+			job = getattr(f, 'job', None)
+			if isinstance(job, Job) and job.job.get('function') is f:
+				yield job
+
 class Job():
 	def __init__(self, **kwargs):
 		self.job = {}
 		self.kwargs = kwargs
 
+		# Runner of a bound job and the bound copies of a declaration
+		self.runner = None
+		self.bound = weakref.WeakSet()
+
 	def __align(self):
-		t = datetime.now().timestamp()
-		self.job['tock'] = datetime.fromtimestamp(
-			t - (t % self.job['interval'].total_seconds()) + self.job['interval'].total_seconds()
-		)
+		t = get_clock().now()
+		self.job['tock'] = t - (t % self.job['interval']) + self.job['interval']
 
 	def __update(self, f, **kwargs):
 		# Build the timedelta
 		timedelta_args = {}
-		for kwkey in ['days', 'seconds', 'microseconds', 'milliseconds', 'minutes', 'hours', 'weeks']:
-			timedelta_args[kwkey] = kwargs.pop(kwkey, 0)
-		interval = timedelta(**timedelta_args)
+		for kwkey in INTERVAL_ARGS:
+			timedelta_args[kwkey] = kwargs.get(kwkey, 0)
+		interval = ns(timedelta(**timedelta_args))
 
 		# Prepare our information
 		self.job['function'] = f
 		self.job['is_standalone'] = is_lambda_function(f) or isinstance(f, functools.partial)
 		self.job['tock']     = None
 		self.job['disabled'] = False
-		self.job['class']    = '' if self.job['is_standalone'] else '.'.join(f.__qualname__.split('.')[:-1])
 		self.job['interval'] = interval
+		self.job['entry']    = self.job.get('entry', 0)
+		self.job['executor'] = kwargs.get('executor')
+		self.job['running']  = self.job.get('running', False)
+		self.job['overrun']  = kwargs.get('overrun', 'coalesce')
+		self.job['max_catch_up'] = kwargs.get('max_catch_up', 10)
+		self.job['is_global'] = self.job.get('is_global', False)
+		self.job['owner']    = self.job.get('owner')
 
-		# Perform any optional behavior
-		if kwargs.get('align', False):
-			self.__align()
+		if self.job['overrun'] not in OVERRUN_POLICIES:
+			raise ValueError(f'Unknown overrun policy {self.job["overrun"]}, use one of {", ".join(OVERRUN_POLICIES)}')
+
+		# Statistics, lateness is in ns
+		for key in ['runs', 'missed', 'late', 'max_late']:
+			self.job[key] = self.job.get(key, 0)
+
+		self.job['name'] = job_name(f)
+		self.job['metrics'] = {
+			'lateness': metrics.JOB_LATENESS.labels(job = self.job['name']),
+			'duration': metrics.JOB_DURATION.labels(job = self.job['name']),
+			'calls': metrics.JOB_CALLS.labels(job = self.job['name']),
+			'missed': metrics.JOB_MISSED.labels(job = self.job['name']),
+			'exceptions': metrics.JOB_EXCEPTIONS.labels(job = self.job['name']),
+		}
+
+		# Aligned jobs get their first tock when a runner schedules them, so they
+		# align to the clock of the runner
+		self.job['align'] = kwargs.get('align', False)
 
 		# Finally store the kwargs
 		self.kwargs = kwargs
@@ -46,49 +135,473 @@ class Job():
 		# Update the job information
 		self.__update(f, **self.kwargs)
 
-		# Register the job
-		jobs.append(self.job)
+		# Methods are only declared here and bound to every instance by its runner,
+		# anything else can run on any runner
+		if self.job['is_standalone']:
+			register(self.job)
 		f.job = self
 
 		# Just return the function without any markup
 		return f
 
-	# Used to change a running job
+	# Copy of this declaration that runs the method of a single instance
+	def bind(self, instance):
+		job = Job(**self.kwargs)
+		job.__update(types.MethodType(self.job['function'], instance), **self.kwargs)
+		job.job['owner'] = instance
+		self.bound.add(job)
+		return job
+
+	# Used to change a running job, changing a declaration changes all its bound copies
 	def update(self, **kwargs):
+		# A new interval replaces the old one
+		if any(key in kwargs for key in INTERVAL_ARGS):
+			for key in INTERVAL_ARGS:
+				self.kwargs.pop(key, None)
+
 		self.kwargs.update(kwargs)
 		self.__update(self.job['function'], **self.kwargs)
 
+		for job in list(self.bound):
+			job.update(**kwargs)
+
+		# Let the runners pick up the new timing
+		if self.runner is not None:
+			self.runner.schedule(self.job)
+		elif self.job['is_global']:
+			for runner in runners:
+				runner.schedule(self.job)
+
 class JobOnce(Job):
-	def __init__(self, f, **kwargs):
+	def __init__(self, f, runner = None, **kwargs):
 		super().__init__(**kwargs)
 		self._Job__update(f, **kwargs)
 
 		# Make it into a single shot
 		if self.kwargs.get('align', False):
-			# Tock is already set to the next aligned hit
+			self._Job__align()
 			self.job['interval'] = None
 		else:
-			self.job['tock'] = datetime.now() + self.job['interval']
+			self.job['tock'] = get_clock().now() + self.job['interval']
 			self.job['interval'] = None
 
-		# Finally we have to register it ourselves
-		jobs.append(self.job)
+		# Finally we have to register it ourselves, at the runner of the instance it
+		# belongs to when we know it
+		owner = resolve(f) if runner is None else runner
+		if owner is None:
+			register(self.job)
+		else:
+			self.job['owner'] = owner
+			owner.job_runner.add(self.job)
 
 class JobRunner():
 	is_running = True
 
+	# Either 'heap' to sleep until the next deadline or 'poll' to scan all jobs
+	# every 1/10 ms
+	scheduler = 'heap'
+	__heap = None
+	__condition = None
+
+	# Named thread pools and their size, jobs select one with @Job(executor='io')
+	executors = {'io': 4}
+	__pools = None
+	__done = None
+	__futures = None
+
+	# Our jobs by id, the instances we run the declared jobs of and their bound
+	# jobs, and the runner we are attached to
+	__jobs = None
+	__instances = None
+	__bound = None
+	__driver = None
+
+	@property
+	def clock(self):
+		return get_clock()
+
+	# Runner that calls our jobs, ourselves unless we are attached to another one
+	@property
+	def job_runner(self):
+		return self if self.__driver is None else self.__driver
+
 	def stop(self):
 		self.is_running = False
 
-	def loop(self):
-		global jobs
+		# An attached instance only takes its jobs off the runner
+		if self.__driver is not None:
+			self.__driver.detach(self)
+			return
+
+		# Wake up the heap scheduler if it is sleeping
+		if self.__condition is not None:
+			with self.__condition:
+				self.__condition.notify()
+
+	# Wrap a callback that other threads call into, like on_snapshot, this runner
+	# calls jobs and callbacks concurrently so it is passed as is
+	def threadsafe(self, callback):
+		if self.__driver is not None:
+			return self.__driver.threadsafe(callback)
+		return callback
+
+	def __setup(self):
+		if self.__jobs is None:
+			self.__jobs = {}
+			self.__instances = []
+			self.__bound = []
+
+	# Run the jobs declared on the class of an instance, by default our own. One
+	# runner can run many instances, each with its own jobs.
+	def attach(self, instance = None):
+		instance = self if instance is None else instance
+		self.__setup()
+		if any(other is instance for other in self.__instances):
+			return
+
+		self.__instances.append(instance)
+		if instance is not self:
+			instance.__driver = self
+
+		for declaration in declarations(type(instance)):
+			job = declaration.bind(instance)
+			job.runner = self
+			self.__bound.append(job)
+			self.add(job.job)
+
+	# Stop running the jobs of an instance, including its JobOnce timers
+	def detach(self, instance):
+		self.__setup()
+		self.__instances = [other for other in self.__instances if other is not instance]
+		self.__bound = [job for job in self.__bound if job.job['owner'] is not instance]
+		if instance is not self:
+			instance.__driver = None
+
+		for job in list(self.__jobs.values()):
+			if job['owner'] is instance:
+				job['disabled'] = True
+				self._remove(job)
+
+	# Bound Job of a method of ours or of an attached instance, to read its
+	# statistics or update just this instance
+	def bound_job(self, method):
+		for job in self.job_runner.__bound or []:
+			if job.job['owner'] is method.__self__ and job.job['function'].__func__ is method.__func__:
+				return job
+		return None
+
+	def add(self, job):
+		self.__setup()
+		self.__jobs[id(job)] = job
+		self.schedule(job)
+
+	# Our own jobs and the jobs any runner may run
+	def _registered(self):
+		self.__setup()
+		return list(self.__jobs.values()) + jobs
+
+	def _remove(self, job):
+		if self.__jobs is not None and self.__jobs.get(id(job)) is job:
+			del self.__jobs[id(job)]
+			return
+
+		try:
+			jobs.remove(job)
+		except ValueError:
+			pass
+
+	def _prune(self):
+		self.__setup()
+		for job in list(self.__jobs.values()):
+			if job['disabled']:
+				del self.__jobs[id(job)]
+		jobs[:] = [job for job in jobs if not job['disabled']]
+
+	def schedule(self, job):
+		# Not looping yet, everything is scheduled when we start
+		if self.__condition is None:
+			return
+
+		with self.__condition:
+			if job['disabled'] or not self._is_own(job):
+				return
+
+			# Every push invalidates the previous heap entry of this job
+			job['entry'] += 1
+
+			# Initialize begin time for a new job
+			if job['tock'] is None:
+				job['tock'] = self._first_tock(job, self.clock.now())
+
+			heapq.heappush(self.__heap, (job['tock'], id(job), job['entry'], job))
+			self.__condition.notify()
+
+	def _first_tock(self, job, now):
+		# Next multiple of the interval
+		if job['align']:
+			return now - (now % job['interval']) + job['interval']
+
+		# Add between zero to one interval to the time
+		# this way we hopefully space out jobs a bit
+		# more
+		return now + int(job['interval'] * random.random())
+
+	def _is_own(self, job):
+		if self.__jobs is not None and self.__jobs.get(id(job)) is job:
+			return True
+
+		# Of the jobs any runner may run, take the ones that make sense for us
+		if not job['is_global']:
+			return False
+
+		if job['is_standalone']:
+			return True
+
+		# Bound methods only run on their own instance
+		f = job['function']
+		if getattr(f, '__self__', None) is not None:
+			return f.__self__ is self
+
+		# Methods run when this class, or a subclass that did not override them, defines them
+		return getattr(type(self), f.__name__, None) is f
+
+	# The function to call, methods that are not bound get us as self
+	def _target(self, job):
+		f = job['function']
+		if job['is_standalone'] or getattr(f, '__self__', None) is not None:
+			return f
+		return functools.partial(f, self)
+
+	# Counts the call of a job, its exceptions and how long it took
+	@contextlib.contextmanager
+	def _measure(self, job):
+		job['metrics']['calls'].inc()
+		start = time.perf_counter_ns()
+		try:
+			yield
+		except Exception:
+			job['metrics']['exceptions'].inc()
+			raise
+		finally:
+			job['metrics']['duration'].record(time.perf_counter_ns() - start)
+
+	def _invoke(self, job):
+		with self._measure(job):
+			return self._target(job)()
+
+	# Move tock to the next deadline following the overrun policy, returns if the job should run now
+	def _advance(self, job, tick):
+		late = tick - job['tock']
+		job['late'] = late
+		job['max_late'] = max(job['max_late'], late)
+
+		interval = job['interval']
+		if not interval:
+			return True
+
+		# Deadlines that passed on top of the one we are handling now
+		behind = late // interval
+		policy = job['overrun']
+
+		if policy == 'run_immediately':
+			job['missed'] += behind
+			job['tock'] = tick + interval
+			return True
+
+		if policy == 'catch_up':
+			# Drop whatever does not fit within the cap, the rest runs back to back
+			dropped = max(0, behind - job['max_catch_up'])
+			job['missed'] += dropped
+			job['tock'] += (dropped + 1) * interval
+			return True
+
+		job['tock'] += (behind + 1) * interval
+		if policy == 'skip' and behind > 0:
+			job['missed'] += behind + 1
+			return False
+
+		job['missed'] += behind
+		return True
+
+	# Bookkeeping of every runner before a job is due, returns if it should run now
+	def _begin(self, job, tick):
+		missed = job['missed']
+		should_run = self._advance(job, tick)
+		job['metrics']['lateness'].record(job['late'])
+
+		# Never run a job concurrently with itself, just wait for the next tock
+		if should_run and job['running']:
+			job['missed'] += 1
+			should_run = False
+
+		if job['missed'] != missed:
+			job['metrics']['missed'].inc(job['missed'] - missed)
+			self.on_job_missed(job)
+
+		if should_run:
+			job['runs'] += 1
+		return should_run
+
+	# Bookkeeping of every runner after a job was started, entry is the one it was
+	# due with
+	def _end(self, job, entry):
+		# Check if this was a single shot
+		if job['interval'] is None:
+			job['disabled'] = True
+
+		# Reschedule periodic jobs unless the job rescheduled itself
+		if job['disabled']:
+			self._remove(job)
+		elif job['interval'] and job['entry'] == entry:
+			self.schedule(job)
+
+	def __call(self, job, tick):
+		entry = job['entry']
+
+		# Now we call our job, either inline or on its pool
+		if not self._begin(job, tick):
+			pass
+		elif job['executor'] is None:
+			self._invoke(job)
+		else:
+			job['running'] = True
+			future = self._pool(job['executor']).submit(self._invoke, job)
+			self.__futures.add(future)
+			future.add_done_callback(self.__futures.discard)
+			future.add_done_callback(functools.partial(self.__on_done, job))
+
+		self._end(job, entry)
+
+	def _pool(self, name):
+		if self.__pools is None:
+			self.__pools = {}
+			self.__done = collections.deque()
+			self.__futures = set()
+
+		if name not in self.__pools:
+			self.__pools[name] = ThreadPoolExecutor(max_workers=self.executors.get(name, 1), thread_name_prefix=name)
+		return self.__pools[name]
+
+	# Runs on the pool thread, hand the result back to the loop
+	def __on_done(self, job, future):
+		self.__done.append((job, future))
+		if self.__condition is not None:
+			with self.__condition:
+				self.__condition.notify()
+
+	def __complete(self):
+		while self.__done:
+			self._finish(*self.__done.popleft())
+
+	def _finish(self, job, future):
+		job['running'] = False
+
+		if future.cancelled():
+			return
+
+		exception = future.exception()
+		if exception is not None:
+			self.on_job_error(job, exception)
+		else:
+			self.on_job_done(job, future.result())
+
+	def on_job_done(self, job, result):
+		pass
+
+	def on_job_missed(self, job):
+		logger.debug(f'Job {job["name"]} missed {job["missed"]} deadlines, {job["late"] / 1e6:.3f} ms late')
+
+	def on_job_error(self, job, exception):
+		logger.error(f'Exception in job {job["name"]}', exc_info=exception)
+
+	def _shutdown(self):
+		# Jobs still queued never start, the running ones finish on their own.
+		# ThreadPoolExecutor only cancels them itself since Python 3.9.
+		for future in list(self.__futures or ()):
+			future.cancel()
+
+		for pool in (self.__pools or {}).values():
+			pool.shutdown(wait=False)
+		self.__pools = None
+
+	# Run until stopped or, when given, until the clock reaches until (in ns)
+	def loop(self, until : int = None):
+		if self.scheduler == 'poll':
+			self.__loop_poll(until)
+		else:
+			self.__loop_heap(until)
+
+	def __loop_heap(self, until):
+		global runners
+
+		self.__heap = []
+		self.__condition = threading.Condition()
+
+		# Bind our own jobs, subscribe for new jobs and schedule everything that is already known
+		self.attach()
+		runners.append(self)
+		for job in self._registered():
+			self.schedule(job)
+
+		try:
+			while self.is_running:
+				# Report finished pool jobs from the loop thread
+				if self.__done:
+					self.__complete()
+
+				with self.__condition:
+					tick = self.clock.now()
+					if until is not None and tick >= until:
+						break
+
+					# A pool job finished while we were busy
+					if self.__done:
+						continue
+
+					# Nothing to do, so wait until somebody registers a job
+					if len(self.__heap) == 0:
+						self.clock.wait(self.__condition, until)
+						continue
+
+					tock, _, entry, job = self.__heap[0]
+
+					# Drop entries that are disabled or rescheduled since
+					if job['disabled'] or job['entry'] != entry:
+						heapq.heappop(self.__heap)
+						continue
+
+					# Sleep exactly until our next deadline, a newly registered
+					# job will wake us up earlier
+					if tick < tock:
+						self.clock.wait(self.__condition, tock if until is None else min(tock, until))
+						continue
+
+					heapq.heappop(self.__heap)
+
+				# Call the job outside of the lock so it can register new jobs
+				self.__call(job, tick)
+
+		except KeyboardInterrupt:
+			pass
+		finally:
+			self._shutdown()
+			runners = [runner for runner in runners if runner is not self]
+			self._prune()
+
+	def __loop_poll(self, until):
+		self.attach()
 
 		try:
 			while self.is_running:
+				if self.__done:
+					self.__complete()
+
 				has_disabled = False
-				tick = datetime.now()
+				tick = self.clock.now()
+				if until is not None and tick >= until:
+					break
 
-				for job in jobs:
+				for job in self._registered():
 					# Make sure to stop as soon as we are not running
 					if not self.is_running:
 						break
@@ -98,43 +611,27 @@ class JobRunner():
 						has_disabled = True
 						continue
 
-					# Check if this function is part of this instance
-					if not job['is_standalone'] and self.__class__.__qualname__ != job['class']:
+					if not self._is_own(job):
 						continue
 
 					# Initialize begin time for a new job
 					if job['tock'] is None:
-						job['tock'] = tick
-
-						# Add between zero to one interval to the time
-						# this way we hopefully space out jobs a bit
-						# more
-						job['tock'] += job['interval'] * random.random()
+						job['tock'] = self._first_tock(job, tick)
 
 					# Initial run
 					if tick >= job['tock']:
-						# Perform all tocks even when we miss a few
-						while job['interval'] and tick >= job['tock']:
-							job['tock'] = job['tock'] + job['interval']
-
-						# Now we call our job
-						if job['is_standalone'] or \
-							 (hasattr(job['function'], '__self__') and job['function'].__self__ is not None):
-							job['function']()
-						else:
-							job['function'](self)
-
-						# Check if this was a single shot
-						if job['interval'] is None:
-							job['disabled'] = has_disabled = True
+						self.__call(job, tick)
+						has_disabled = has_disabled or job['disabled']
 
 				# We run our loop every 1/10 ms.
 				# This enables us to not to exhaust the CPU!
-				time.sleep(1 / 10000)
+				self.clock.sleep(1 / 10000)
 
 				# Remove any disabled jobs
 				if has_disabled:
-					jobs = [job for job in jobs if not job['disabled']]
+					self._prune()
 
 		except KeyboardInterrupt:
 			pass
+		finally:
+			self._shutdown()
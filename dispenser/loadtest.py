@@ -0,0 +1,252 @@
+import os
+import sys
+import json
+import random
+import shutil
+import logging
+import argparse
+import tempfile
+import collections
+from functools import partial
+from datetime import datetime, timedelta, timezone
+from dispenser.job import JobOnce, JobRunner, ns
+from dispenser.metrics import HistogramValue
+from dispenser.store import MemoryStore
+from dispenser.hardware import RotorModel, SimulatedHardware
+
+logger = logging.getLogger(__name__)
+
+# Players never tap twice within the read grace of the dispenser
+MIN_VISIT = 4
+
+# Players walking between dispensers, checking in and out with their tag
+class LoadTest():
+	def __init__(self, store : MemoryStore, dispensers : list, players : list, visit : float, idle : float, forget : float, seed : int = None):
+		self.store = store
+		self.dispensers = dispensers
+		self.players = {uid: None for uid in players}
+		self.visit = visit
+		self.idle = idle
+		self.forget = forget if len(dispensers) > 1 else 0
+		self.random = random.Random(seed)
+
+		# Taps waiting to show up in the area document, by (area, uid)
+		self.checkins = {}
+		self.checkouts = {}
+		self.checkin_latency = HistogramValue()
+		self.checkout_latency = HistogramValue()
+		self.counts = collections.Counter()
+
+		# Watch the areas like the scoreboard does
+		self.watches = [dispenser.area_ref.on_snapshot(partial(self.on_area, dispenser.area)) for dispenser in dispensers]
+
+	@property
+	def clock(self):
+		return self.dispensers[0].clock
+
+	def start(self, warmup : float):
+		for uid in self.players:
+			JobOnce(partial(self.arrive, uid), seconds = warmup + self.random.uniform(0, self.idle))
+
+	def stop(self):
+		for watch in self.watches:
+			watch.unsubscribe()
+
+	def arrive(self, uid : str):
+		# Never at the dispenser we are still checked in at
+		choices = [dispenser for dispenser in self.dispensers if dispenser.area != self.players[uid]]
+		dispenser = self.random.choice(choices)
+
+		if self.players[uid] is not None:
+			self.counts['forgotten'] += 1
+		self.players[uid] = dispenser.area
+		self.checkins[(dispenser.area, uid)] = (self.clock.now(), datetime.now(timezone.utc))
+		self.counts['checkins'] += 1
+		dispenser.hardware.tap(uid)
+
+		JobOnce(partial(self.leave, uid, dispenser), seconds = max(MIN_VISIT, self.random.expovariate(1 / self.visit)))
+
+	def leave(self, uid : str, dispenser):
+		# Walk off without checking out, the next check in will do that for us
+		if self.random.random() < self.forget:
+			JobOnce(partial(self.arrive, uid), seconds = self.random.expovariate(1 / self.idle))
+			return
+
+		self.players[uid] = None
+		if (dispenser.area, uid) not in self.checkins:
+			self.checkouts[(dispenser.area, uid)] = self.clock.now()
+		else:
+			# Its check in never showed up, so neither would this check out
+			self.counts['unobserved'] += 1
+		self.counts['checkouts'] += 1
+		dispenser.hardware.tap(uid)
+
+		JobOnce(partial(self.arrive, uid), seconds = max(MIN_VISIT, self.random.expovariate(1 / self.idle)))
+
+	def on_area(self, area : str, snapshot, changes, read_time):
+		now = self.clock.now()
+		for doc in snapshot:
+			players = (doc.to_dict() or {}).get('players') or {}
+
+			for key, (tick, tapped) in list(self.checkins.items()):
+				player = players.get(key[1]) or {}
+				if key[0] == area and player.get('present') is True and isinstance(player.get('checkin'), datetime) and player['checkin'] >= tapped:
+					del self.checkins[key]
+					self.checkin_latency.record(now - tick)
+
+			for key, tick in list(self.checkouts.items()):
+				if key[0] == area and (players.get(key[1]) or {}).get('present') is not True:
+					del self.checkouts[key]
+					self.checkout_latency.record(now - tick)
+
+	def report(self, duration : float):
+		store = self.store
+		commits = sum(store.fanout.values())
+		writes = store.stats['writes']
+
+		def latency(histogram, pending):
+			return {
+				'count': histogram.count,
+				'pending': pending,
+				**{f'p{q * 100:g}_ms': histogram.quantile(q) / 1e6 for q in (0.5, 0.9, 0.99)},
+				'max_ms': histogram.max / 1e6,
+			}
+
+		return {
+			'dispensers': len(self.dispensers),
+			'players': len(self.players),
+			'duration_s': duration,
+			'visits': dict(self.counts),
+			'writes': {
+				'commits': commits,
+				'writes': writes,
+				'failures': store.stats['failures'],
+				'commits_per_s': commits / duration,
+				'writes_per_s': writes / duration,
+			},
+			'contention': {
+				'contended': store.stats['contended'],
+				'ratio': store.stats['contended'] / writes if writes else 0,
+				'documents': [
+					{
+						'path': path,
+						'writes': count,
+						'writes_per_s': count / duration,
+						'contended': store.document_contention[path],
+					}
+					for path, count in store.document_writes.most_common(5)
+				],
+			},
+			'fanout': {
+				'snapshots': store.stats['snapshots'],
+				'changes': store.stats['changes'],
+				'watches_per_commit': sum(watches * count for watches, count in store.fanout.items()) / commits if commits else 0,
+				'max_watches_per_commit': max(store.fanout, default = 0),
+				'changes_per_snapshot': store.stats['changes'] / store.stats['snapshots'] if store.stats['snapshots'] else 0,
+			},
+			'checkin_latency': latency(self.checkin_latency, len(self.checkins)),
+			'checkout_latency': latency(self.checkout_latency, len(self.checkouts)),
+			'journal_pending': sum(len(dispenser.journal.pending()) for dispenser in self.dispensers),
+		}
+
+def print_report(report : dict):
+	writes = report['writes']
+	contention = report['contention']
+	fanout = report['fanout']
+
+	print(f'{report["dispensers"]} dispensers, {report["players"]} players, {report["duration_s"]:.0f}s')
+	print(f'Visits       {", ".join(f"{key} {value}" for key, value in sorted(report["visits"].items()))}')
+	print(f'Writes       {writes["writes_per_s"]:.1f} writes/s in {writes["commits_per_s"]:.1f} commits/s, {writes["failures"]} failed commits')
+	print(f'Contention   {contention["contended"]} writes ({contention["ratio"]:.1%}) within a second of the previous write to the same document')
+	for document in contention['documents']:
+		print(f'  {document["path"]:<40} {document["writes"]:>6} writes {document["writes_per_s"]:>6.2f}/s {document["contended"]:>6} contended')
+	print(f'Fan-out      {fanout["snapshots"]} snapshots, {fanout["watches_per_commit"]:.2f} watches per commit (max {fanout["max_watches_per_commit"]}), {fanout["changes_per_snapshot"]:.2f} changes per snapshot')
+	for name in ('checkin_latency', 'checkout_latency'):
+		latency = report[name]
+		print(f'{name.split("_")[0].capitalize():<12} {latency["count"]} seen, {latency["pending"]} pending, p50 {latency["p50_ms"]:.0f} ms, p90 {latency["p90_ms"]:.0f} ms, p99 {latency["p99_ms"]:.0f} ms, max {latency["max_ms"]:.0f} ms')
+	print(f'Journal      {report["journal_pending"]} entries not acknowledged')
+
+def main():
+	from dispenser.dispenser import Dispenser
+
+	parser = argparse.ArgumentParser(description = 'Load test simulated dispensers against an in-process store')
+	parser.add_argument('--dispensers', type = int, default = 4, help = 'number of simulated dispensers, one area each')
+	parser.add_argument('--players', type = int, default = 40, help = 'number of players walking between them')
+	parser.add_argument('--duration', type = float, default = 60, help = 'seconds to run')
+	parser.add_argument('--visit', type = float, default = 15, help = 'mean seconds a player stays checked in')
+	parser.add_argument('--idle', type = float, default = 10, help = 'mean seconds between visits')
+	parser.add_argument('--forget', type = float, default = 0.2, help = 'fraction of visits that end without checking out')
+	parser.add_argument('--tick-seconds', type = int, default = 5, help = 'seconds per credit of every area')
+	parser.add_argument('--latency', type = float, nargs = '+', default = [50, 500], metavar = 'MS', help = 'store latency in ms, or a range of two')
+	parser.add_argument('--failure-rate', type = float, default = 0, help = 'fraction of commits that fail')
+	parser.add_argument('--seed', type = int, help = 'seed for players and store')
+	parser.add_argument('--data-dir', help = 'directory for journals and player caches, a temporary one when not given')
+	parser.add_argument('--json', help = 'also write the report as JSON to this file')
+	parser.add_argument('--verbose', action = 'store_true', help = 'log everything the dispensers do')
+	args = parser.parse_args()
+
+	if len(args.latency) > 2:
+		parser.error('--latency takes one or two values')
+
+	if not args.verbose:
+		logging.getLogger().setLevel(logging.WARNING)
+
+	latency = [ms / 1000 for ms in args.latency]
+	store = MemoryStore(
+		latency = latency[0] if len(latency) == 1 else tuple(latency),
+		failure_rate = args.failure_rate,
+		seed = args.seed,
+	)
+
+	# Every player is known, every area has the same game
+	players = [f'04{i:012X}' for i in range(args.players)]
+	areas = [f'load{i}' for i in range(args.dispensers)]
+	batch = store.batch()
+	for i, uid in enumerate(players):
+		batch.set(store.player(uid), {'name': f'Player {i}'})
+	for area in areas:
+		batch.set(store.area(area), {'tick_seconds': args.tick_seconds, 'tick_amount': 1})
+	batch.commit()
+
+	path = args.data_dir or tempfile.mkdtemp(prefix = 'dispenser-loadtest-')
+	dispensers = []
+	try:
+		for i, area in enumerate(areas):
+			dispensers.append(Dispenser(
+				area = area,
+				hardware = SimulatedHardware(RotorModel(coins = 1000000, seed = i)),
+				store = store,
+				journal_path = os.path.join(path, area, 'journal'),
+				cache_path = os.path.join(path, area, 'players.sqlite'),
+			))
+
+		# One runner for the whole fleet, like one Pi driving many heads
+		fleet = JobRunner()
+		for dispenser in dispensers:
+			fleet.attach(dispenser)
+		test = LoadTest(store, dispensers, players, args.visit, args.idle, args.forget, args.seed)
+
+		# Give the players watches time to deliver everyone
+		warmup = 2 + max(latency)
+		test.start(warmup)
+		start = fleet.clock.now()
+		fleet.loop(start + ns(timedelta(seconds = warmup + args.duration)))
+		test.stop()
+
+		report = test.report((fleet.clock.now() - start) / 1e9)
+	finally:
+		for dispenser in dispensers:
+			dispenser.close()
+		store.close()
+		if args.data_dir is None:
+			shutil.rmtree(path, ignore_errors = True)
+
+	print_report(report)
+	if args.json:
+		with open(args.json, 'w') as f:
+			json.dump(report, f, indent = 2)
+
+	return 0 if report['checkin_latency']['count'] else 1
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,184 @@
+import time
+import threading
+import functools
+import contextlib
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Histograms keep 2^SUB_BITS linear buckets per power of two (about 6% resolution)
+# for values up to 2^MAX_BITS ns (about 18 minutes), so memory is fixed
+SUB_BITS = 4
+MAX_BITS = 40
+MAX_VALUE = (1 << MAX_BITS) - 1
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+PORT = 9400
+
+# Every declared metric, in declaration order
+families = []
+
+def bucket(value):
+	shift = max(0, value.bit_length() - SUB_BITS - 1)
+	return (shift << SUB_BITS) + (value >> shift)
+
+def bucket_upper(index):
+	if index < 2 << SUB_BITS:
+		return index
+	shift = (index >> SUB_BITS) - 1
+	top = index - (shift << SUB_BITS)
+	return ((top + 1) << shift) - 1
+
+def escape(value):
+	return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(labels):
+	if not labels:
+		return ''
+	return '{' + ','.join(f'{key}="{escape(value)}"' for key, value in labels) + '}'
+
+
+class CounterValue():
+	def __init__(self):
+		self.value = 0
+		self.lock = threading.Lock()
+
+	def inc(self, amount = 1):
+		with self.lock:
+			self.value += amount
+
+class HistogramValue():
+	def __init__(self):
+		self.counts = [0] * (bucket(MAX_VALUE) + 1)
+		self.count = 0
+		self.sum = 0
+		self.max = 0
+		self.lock = threading.Lock()
+
+	# Values are in ns
+	def record(self, value):
+		value = min(max(int(value), 0), MAX_VALUE)
+		with self.lock:
+			self.counts[bucket(value)] += 1
+			self.count += 1
+			self.sum += value
+			self.max = max(self.max, value)
+
+	def quantile(self, q):
+		with self.lock:
+			rank = q * self.count
+			seen = 0
+			for index, count in enumerate(self.counts):
+				seen += count
+				if count and seen >= rank:
+					return min(bucket_upper(index), self.max)
+			return self.max
+
+	@contextlib.contextmanager
+	def time(self):
+		start = time.perf_counter_ns()
+		try:
+			yield self
+		finally:
+			self.record(time.perf_counter_ns() - start)
+
+
+class Metric():
+	type = None
+	value = None
+
+	def __init__(self, name, help, labels = ()):
+		self.name = name
+		self.help = help
+		self.label_names = tuple(labels)
+		self.children = {}
+		self.lock = threading.Lock()
+		families.append(self)
+
+	def labels(self, **labels):
+		key = tuple((name, labels.get(name, '')) for name in self.label_names)
+		child = self.children.get(key)
+		if child is None:
+			with self.lock:
+				child = self.children.setdefault(key, self.value())
+		return child
+
+	def render(self):
+		lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+		for labels, child in list(self.children.items()):
+			lines.extend(self.render_child(labels, child))
+		return lines
+
+class Counter(Metric):
+	type = 'counter'
+	value = CounterValue
+
+	def render_child(self, labels, child):
+		return [f'{self.name}{format_labels(labels)} {child.value}']
+
+# Exported as a summary in seconds, the quantiles are calculated on scrape
+class Histogram(Metric):
+	type = 'summary'
+	value = HistogramValue
+
+	def render_child(self, labels, child):
+		lines = []
+		for q in QUANTILES + (1, ):
+			lines.append(f'{self.name}{format_labels(labels + (("quantile", q), ))} {child.quantile(q) / 1e9:.9f}')
+		lines.append(f'{self.name}_sum{format_labels(labels)} {child.sum / 1e9:.9f}')
+		lines.append(f'{self.name}_count{format_labels(labels)} {child.count}')
+		return lines
+
+	# Decorator to time every call of a function
+	def timed(self, **labels):
+		def decorator(f):
+			child = self.labels(**labels)
+
+			@functools.wraps(f)
+			def wrapper(*args, **kwargs):
+				with child.time():
+					return f(*args, **kwargs)
+			return wrapper
+		return decorator
+
+
+def render():
+	lines = []
+	for family in list(families):
+		lines.extend(family.render())
+	return '\n'.join(lines) + '\n'
+
+class MetricsHandler(BaseHTTPRequestHandler):
+	def do_GET(self):
+		if self.path.split('?')[0] not in ('/', '/metrics'):
+			self.send_error(404)
+			return
+
+		body = render().encode('utf-8')
+		self.send_response(200)
+		self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	# Do not log every scrape
+	def log_message(self, format, *args):
+		pass
+
+# Serve the metrics in Prometheus text format from a background thread
+def serve(port = PORT, address = ''):
+	server = ThreadingHTTPServer((address, port), MetricsHandler)
+	server.daemon_threads = True
+	threading.Thread(target = server.serve_forever, name = 'metrics', daemon = True).start()
+	return server
+
+
+# Metrics shared by the whole dispenser
+JOB_LATENESS = Histogram('dispenser_job_lateness_seconds', 'Time between the deadline of a job and its start', ['job'])
+JOB_DURATION = Histogram('dispenser_job_duration_seconds', 'Execution time of a job', ['job'])
+JOB_CALLS = Counter('dispenser_job_calls_total', 'Number of job runs', ['job'])
+JOB_MISSED = Counter('dispenser_job_missed_total', 'Number of missed job deadlines', ['job'])
+JOB_EXCEPTIONS = Counter('dispenser_job_exceptions_total', 'Number of jobs that raised an exception', ['job'])
+FIRESTORE_COMMIT = Histogram('dispenser_firestore_commit_seconds', 'Duration of Firestore batch commits', ['result'])
+FIRESTORE_WRITES = Counter('dispenser_firestore_writes_total', 'Number of writes committed to Firestore')
+SNAPSHOT_CALLBACK = Histogram('dispenser_snapshot_callback_seconds', 'Duration of Firestore snapshot callbacks', ['callback'])
+RFID_READ = Histogram('dispenser_rfid_read_seconds', 'Duration of reading a tag UID', [])
+JAMS = Counter('dispenser_jams_total', 'Number of detected jams', ['reason'])
@@ -0,0 +1,117 @@
+import logging
+from datetime import timedelta
+from dispenser.job import ns
+
+logger = logging.getLogger(__name__)
+
+# PWM values of the continuous rotation servo, lower is faster forward
+MOTOR_ON = 100
+MOTOR_REVERSE = 200
+MOTOR_OFF = 150
+
+# Longest servo pulse we write, in steps of 10 us
+PWM_MAX = 250
+
+# Parameters that are written to the servo, the others are counts and thresholds
+PWM_PARAMS = ('off', 'neutral', 'full', 'start', 'slow', 'reverse')
+
+# Calibration of a unit, the motor field of the area document overrides any of these
+DEFAULTS = {
+	# Written to stop the motor
+	'off': MOTOR_OFF,
+	# Where the motor stands still
+	'neutral': MOTOR_OFF,
+	# Fastest we ever go
+	'full': MOTOR_ON,
+	# First half rotation of a payout
+	'start': 115,
+	# Aligning and the last coins of a payout, so we never overshoot
+	'slow': 125,
+	'slow_coins': 1,
+	'reverse': MOTOR_REVERSE,
+	# Most PWM steps to speed up per half rotation
+	'ramp': 10,
+	# Shortest half rotation, the alignment marker has to stay longer than T_DETECT_BIG
+	'min_period_ms': 450,
+	# Jam thresholds in percent of the usual half rotation, longest edge gap and
+	# half rotation for a steady slowdown, see dispenser.jam
+	'jam_slowdown_pct': 250,
+	'jam_stall_pct': 300,
+	'jam_trend_pct': 180,
+	# Empty pockets in a row before we call the hopper empty
+	'empty_rotations': 2,
+}
+
+# Calibration known before the area document arrives
+CALIBRATIONS = {
+	'blue': {'off': 0},
+}
+
+# Smoothing of the learned response of the motor
+ALPHA = 0.3
+
+# Sets the PWM for every half rotation of a payout. It learns the response of
+# this unit (half rotation period times speed is about constant) and uses that
+# to go as fast as possible without going below min_period_ms.
+class MotorController():
+	def __init__(self, params : dict = None):
+		self.params = dict(DEFAULTS)
+		self.response = None
+		self.pwm = self.params['off']
+		self.configure(params or {})
+
+	def configure(self, params : dict):
+		for key, value in params.items():
+			if key not in DEFAULTS:
+				logger.warning(f'Unknown motor parameter {key}')
+				continue
+
+			try:
+				if isinstance(value, bool):
+					raise TypeError(f'{value} is not a number')
+				value = int(value)
+			except (TypeError, ValueError, OverflowError) as e:
+				logger.error(f'Ignoring motor parameter {key}: {e}')
+				continue
+
+			# Out of range is most likely a typo, stay within what the servo takes
+			clamped = max(0, min(PWM_MAX, value) if key in PWM_PARAMS else value)
+			if clamped != value:
+				logger.warning(f'Motor parameter {key} {value} out of range, using {clamped}')
+			self.params[key] = clamped
+
+	# Speed is the distance from neutral towards full
+	def speed(self, pwm : int):
+		return (self.params['neutral'] - pwm) * (1 if self.params['full'] < self.params['neutral'] else -1)
+
+	def to_pwm(self, speed : float):
+		return self.params['neutral'] - round(speed) * (1 if self.params['full'] < self.params['neutral'] else -1)
+
+	def start(self, remaining : int):
+		self.pwm = self.params['slow'] if remaining <= self.params['slow_coins'] else self.params['start']
+		return self.pwm
+
+	def align(self):
+		self.pwm = self.params['slow']
+		return self.pwm
+
+	# Called after every half rotation with its period (in ns), returns the new PWM
+	def on_half_rotation(self, period : int, remaining : int):
+		speed = self.speed(self.pwm)
+		if period > 0 and speed > 0:
+			response = period * speed
+			self.response = response if self.response is None else (1 - ALPHA) * self.response + ALPHA * response
+
+		slow = self.speed(self.params['slow'])
+		if remaining <= self.params['slow_coins']:
+			speed = slow
+		else:
+			speed = min(self.speed(self.params['full']), speed + self.params['ramp'])
+
+			# Never faster than the marker detection allows
+			if self.response is not None:
+				speed = min(speed, self.response / ns(timedelta(milliseconds=self.params['min_period_ms'])))
+			speed = max(speed, slow)
+
+		self.pwm = self.to_pwm(speed)
+		return self.pwm
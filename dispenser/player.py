@@ -0,0 +1,57 @@
+from datetime import datetime, timedelta, timezone
+
+EPOCH = datetime(1970, 1, 1, tzinfo = timezone.utc)
+
+# Conversion between Firestore timestamps and our integer nanoseconds since the epoch
+def to_ns(value : datetime) -> int:
+	return (value - EPOCH) // timedelta(microseconds = 1) * 1000
+
+def to_datetime(value : int) -> datetime:
+	return EPOCH + timedelta(microseconds = value // 1000)
+
+# Cheap check whether a remote player changed since we last saw it
+def fingerprint(data : dict):
+	try:
+		return hash(frozenset(data.items()))
+	except TypeError:
+		return None
+
+class Player():
+	__slots__ = ('last_read', 'tick', 'checkin', 'credit', 'present', 'name')
+
+	def __init__(self, last_read : int = 0, tick : int = 0, credit : int = 0, present : bool = False):
+		self.last_read = last_read
+		self.tick = tick
+		self.checkin = tick
+		self.credit = credit
+		self.present = present
+		self.name = None
+
+	# Apply a player from the area document and return whether anything changed
+	def update_remote(self, data : dict) -> bool:
+		is_changed = False
+
+		for field in ('tick', 'checkin'):
+			value = data.get(field)
+			if isinstance(value, datetime):
+				value = to_ns(value)
+				if getattr(self, field) != value:
+					setattr(self, field, value)
+					is_changed = True
+
+		for field in ('credit', 'present', 'name'):
+			if field in data and getattr(self, field) != data[field]:
+				setattr(self, field, data[field])
+				is_changed = True
+
+		return is_changed
+
+class PlayerDetails():
+	__slots__ = ('name', 'area')
+
+	def __init__(self, name : str = None, area : str = None):
+		self.name = name
+		self.area = area
+
+	def __eq__(self, other):
+		return isinstance(other, PlayerDetails) and self.name == other.name and self.area == other.area
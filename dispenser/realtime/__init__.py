@@ -0,0 +1 @@
+from dispenser.realtime.channel import Channel
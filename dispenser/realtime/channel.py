@@ -0,0 +1,83 @@
+import struct
+from multiprocessing import shared_memory
+
+# type, led, uid, a, b, c, sequence
+MESSAGE = struct.Struct('<BB7sxiiiQ')
+SLOT = 32
+
+# Head and tail live on their own cache line
+HEAD = 0
+TAIL = 64
+SLOTS = 128
+COUNTER = struct.Struct('<Q')
+
+# Commands, from the sync process to the controller
+DISPENSE = 1
+ALIGN = 2
+LED = 3
+FLASH = 4
+STOP = 5
+MOTOR = 6
+
+# Events, from the controller to the sync process
+READY = 64
+HALF_ROTATION = 65
+JAM = 66
+DONE = 67
+TAG = 68
+
+class Channel():
+	# Single producer, single consumer ring of fixed size messages in shared memory.
+	# Each slot carries its own sequence number, so a reader never takes a slot
+	# that is not completely written yet.
+	def __init__(self, name : str = None, size : int = 256):
+		if size & (size - 1):
+			raise ValueError('Channel size must be a power of two')
+
+		self.is_owner = name is None
+		if self.is_owner:
+			self.memory = shared_memory.SharedMemory(create = True, size = SLOTS + size * SLOT)
+			COUNTER.pack_into(self.memory.buf, HEAD, 0)
+			COUNTER.pack_into(self.memory.buf, TAIL, 0)
+		else:
+			self.memory = shared_memory.SharedMemory(name = name)
+
+		self.name = self.memory.name
+		self.size = (self.memory.size - SLOTS) // SLOT
+		self.mask = self.size - 1
+
+	def put(self, type : int, uid : str = '', led : int = 0, a : int = 0, b : int = 0, c : int = 0) -> bool:
+		buf = self.memory.buf
+		head = COUNTER.unpack_from(buf, HEAD)[0]
+		if head - COUNTER.unpack_from(buf, TAIL)[0] >= self.size:
+			return False
+
+		uid = bytes.fromhex(uid) if uid else bytes(7)
+		MESSAGE.pack_into(buf, SLOTS + (head & self.mask) * SLOT, type, led, uid, a, b, c, head + 1)
+		COUNTER.pack_into(buf, HEAD, head + 1)
+		return True
+
+	def get(self):
+		buf = self.memory.buf
+		tail = COUNTER.unpack_from(buf, TAIL)[0]
+		if tail == COUNTER.unpack_from(buf, HEAD)[0]:
+			return None
+
+		type, led, uid, a, b, c, sequence = MESSAGE.unpack_from(buf, SLOTS + (tail & self.mask) * SLOT)
+		if sequence != tail + 1:
+			return None
+
+		COUNTER.pack_into(buf, TAIL, tail + 1)
+		return {
+			'type': type,
+			'led': led,
+			'uid': uid.hex().upper() if any(uid) else '',
+			'a': a,
+			'b': b,
+			'c': c,
+		}
+
+	def close(self):
+		self.memory.close()
+		if self.is_owner:
+			self.memory.unlink()
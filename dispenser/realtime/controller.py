@@ -0,0 +1,106 @@
+import os
+import logging
+from dispenser.job import Job, JobRunner
+from dispenser.rotor import Rotor, LEDS
+from dispenser.motor import DEFAULTS
+from dispenser.realtime.channel import Channel, DISPENSE, ALIGN, LED, FLASH, STOP, MOTOR, READY, HALF_ROTATION, JAM, DONE, TAG
+
+logger = logging.getLogger(__name__)
+
+LED_NAMES = list(LEDS.keys())
+MOTOR_PARAMS = list(DEFAULTS.keys())
+
+# Runs the rotor, IR and tag reader in its own process. Commands come in and events
+# go out over shared memory channels, so nothing here waits on the network.
+class Controller(Rotor, JobRunner):
+	is_closed = False
+
+	def __init__(self, commands : str, events : str, motor : dict, rfid_irq : int = None, rfid_poll : int = None):
+		self.commands = Channel(commands)
+		self.events = Channel(events)
+		self.motor_calibration = motor
+		self.rfid_irq = rfid_irq
+		if rfid_poll is not None:
+			self.rfid_poll = rfid_poll
+
+		self.setup_hardware()
+		self.emit(READY)
+
+	def emit(self, type : int, **kwargs):
+		if not self.events.put(type, **kwargs):
+			logger.error(f'Event channel full, dropping event {type}')
+
+	# Every run drains the channel
+	@Job(milliseconds = 1, overrun = 'skip')
+	def job_commands(self):
+		while True:
+			message = self.commands.get()
+			if message is None:
+				break
+
+			if message['type'] == DISPENSE:
+				self.dispense(message['a'], message['uid'] or None)
+			elif message['type'] == ALIGN:
+				self.align_rotor()
+			elif message['type'] == LED:
+				self.set_led(LED_NAMES[message['led']], message['a'])
+			elif message['type'] == FLASH:
+				self.set_led_flash(LED_NAMES[message['led']], message['a'], message['b'] / 1000, message['c'])
+			elif message['type'] == MOTOR:
+				self.configure_motor({MOTOR_PARAMS[message['led']]: message['a']})
+			elif message['type'] == STOP:
+				self.close()
+				return
+
+	def on_half_rotation(self, has_coin):
+		super().on_half_rotation(has_coin)
+		self.emit(HALF_ROTATION, a = int(has_coin), b = self.current_dispense_no)
+
+	def on_jam(self):
+		self.emit(JAM, a = self.current_dispense_no)
+
+	def on_tag(self, uid : str):
+		self.emit(TAG, uid = uid)
+
+	def on_dispense_done(self, amount : int, requested : int, uid : str = None):
+		self.emit(DONE, uid = uid or '', a = amount, b = requested)
+
+	def close(self, *args):
+		if self.is_closed:
+			return
+		self.is_closed = True
+		self.stop()
+
+		logger.info('Closing controller')
+		self.close_hardware()
+		self.commands.close()
+		self.events.close()
+
+def run(commands : str, events : str, motor : dict, core : int = None, priority : int = None, rfid_irq : int = None, rfid_poll : int = None):
+	import signal
+
+	logging.basicConfig(
+		format='%(asctime)s - %(levelname)s - controller - %(message)s',
+		level=logging.INFO
+	)
+
+	# Keep the scheduler of other processes away from our timing
+	if core is not None:
+		os.sched_setaffinity(0, {core})
+
+	if priority is not None:
+		try:
+			os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+		except PermissionError:
+			logger.warning('Not allowed to use SCHED_FIFO, using the default scheduler')
+
+	controller = Controller(commands, events, motor, rfid_irq, rfid_poll)
+
+	# The sync process owns our lifetime
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+	signal.signal(signal.SIGTERM, controller.close)
+
+	try:
+		controller.loop()
+	finally:
+		controller.close()
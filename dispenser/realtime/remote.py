@@ -0,0 +1,122 @@
+import logging
+import collections
+import multiprocessing
+from dispenser.job import Job
+from dispenser.dispenser import Dispenser
+from dispenser.rotor import LOW
+from dispenser.realtime.channel import Channel, DISPENSE, ALIGN, LED, FLASH, STOP, MOTOR, READY, HALF_ROTATION, JAM, DONE, TAG
+from dispenser.realtime.controller import LED_NAMES, MOTOR_PARAMS
+
+logger = logging.getLogger(__name__)
+
+# Dispenser that leaves the motor, IR and tag reader to a real-time controller process
+# and only handles the game and Firestore itself
+class RealtimeDispenser(Dispenser):
+	# These run in the controller process instead
+	job_check_rotor = None
+	job_check_rotor_recovery = None
+	job_read_tag = None
+
+	controller = None
+
+	def __init__(self, core : int = None, priority : int = None, **kwargs):
+		self.core = core
+		self.priority = priority
+		super().__init__(**kwargs)
+
+	def setup_hardware(self):
+		self.payouts = collections.deque()
+		self.commands = Channel()
+		self.events = Channel()
+		self.start_controller()
+
+	def start_controller(self):
+		from dispenser.realtime import controller
+
+		# Spawn, so the controller does not inherit any of our (Firestore) threads
+		context = multiprocessing.get_context('spawn')
+		self.controller = context.Process(
+			target = controller.run,
+			args = (self.commands.name, self.events.name, self.motor_calibration, self.core, self.priority, self.rfid_irq, self.rfid_poll),
+			name = 'controller',
+			daemon = True,
+		)
+		self.controller.start()
+
+	def close_hardware(self):
+		self.command(STOP)
+		self.controller.join(5)
+		if self.controller.is_alive():
+			self.controller.terminate()
+
+		self.commands.close()
+		self.events.close()
+
+	def command(self, type : int, **kwargs):
+		if not self.commands.put(type, **kwargs):
+			logger.error(f'Command channel full, dropping command {type}')
+
+	# Every run drains the channel
+	@Job(milliseconds = 5, overrun = 'skip')
+	def job_events(self):
+		# Restart the controller when it died on us
+		if not self.is_closed and not self.controller.is_alive():
+			logger.error(f'Controller stopped with {self.controller.exitcode}, restarting')
+
+			# Anything queued is lost with it, these players keep their credit
+			if self.payouts:
+				logger.error(f'Dropping {len(self.payouts)} payouts')
+				self.payouts.clear()
+				self.dispense_no = 0
+			self.start_controller()
+			return
+
+		while True:
+			message = self.events.get()
+			if message is None:
+				break
+
+			if message['type'] == READY:
+				logger.info('Controller is ready')
+			elif message['type'] == HALF_ROTATION:
+				self.current_dispense_no = message['b']
+			elif message['type'] == JAM:
+				logger.error(f'Controller reported a jam after {message["a"]} coins')
+			elif message['type'] == DONE:
+				# The controller continues with the next queued payout by itself
+				self.payouts.popleft()
+				self.dispense_no = self.payouts[0][1] if self.payouts else 0
+				self.on_dispense_done(message['a'], message['b'], message['uid'] or None)
+			elif message['type'] == TAG:
+				self.on_tag(message['uid'])
+
+	def align_rotor(self):
+		self.command(ALIGN)
+
+	def dispense(self, amount : int, uid : str = None):
+		logger.info(f'Dispensing {amount:d}')
+		if amount <= 0:
+			return
+
+		# The controller queues it when busy, we track it for is_dispensing
+		self.payouts.append((uid, amount))
+		if self.dispense_no <= 0:
+			self.dispense_no = amount
+			self.current_dispense_no = 0
+		self.command(DISPENSE, uid = uid or '', a = amount)
+
+	def is_dispensing(self, uid : str):
+		return any(queued == uid for queued, _ in self.payouts)
+
+	def configure_motor(self, params : dict):
+		for key, value in params.items():
+			if key in MOTOR_PARAMS:
+				self.command(MOTOR, led = MOTOR_PARAMS.index(key), a = int(value))
+
+		self.motor_off = params.get('off', self.motor_off)
+
+	def set_led(self, led : str, value):
+		self.command(LED, led = LED_NAMES.index(led), a = value)
+
+	def set_led_flash(self, led : str, amount : int, seconds : int, end_value : int, value : int = LOW):
+		self.command(FLASH, led = LED_NAMES.index(led), a = amount, b = int(seconds * 1000), c = end_value)
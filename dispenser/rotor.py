@@ -0,0 +1,372 @@
+import logging
+import collections
+from functools import partial
+from datetime import timedelta
+from dispenser.job import Job, JobOnce, ns
+from dispenser.motor import MotorController, MOTOR_OFF
+from dispenser.jam import JamDetector
+from dispenser.coin import CoinClassifier
+from dispenser.hardware import T_TAG_POLL, HIGH, LOW, LEDS
+
+logger = logging.getLogger(__name__)
+
+T_JAM = ns(timedelta(seconds=2))
+
+# Motor, IR and tag reader handling, shared by the dispenser and the real-time controller
+class Rotor():
+	# All variables
+	is_calibrating = False
+	dispense_no = 0
+	current_dispense_no = 0
+	leading_edge_at = None
+	motor_off = MOTOR_OFF
+	motor_speed = MOTOR_OFF
+	motor_changed_at = 0
+	motor_started_at = 0
+	motor_calibration = None
+	is_motor_starting = False
+	is_recovery = False
+	previous_ir_state = 0
+	previous_edge_time = None
+	marker_edges = 0
+	marker_edges_seen = 0
+	last_rotate_time = 0
+	empty_count = 0
+
+	# Empty list
+	is_coin_empty = False
+	coin_presences = None
+
+	# Payout in progress and the (uid, amount) payouts queued behind it
+	dispense_uid = None
+	payouts = None
+
+	# Board pin of the RC522 IRQ line, None to poll for tags every rfid_poll ns
+	rfid_irq = None
+	rfid_poll = T_TAG_POLL
+
+	# The board we run on, a Raspberry Pi unless given
+	hardware = None
+
+	def setup_hardware(self):
+		# Setup all required hardware
+		if self.hardware is None:
+			from dispenser.hardware.hardware import PiHardware
+			self.hardware = PiHardware()
+		self.hardware.setup()
+
+		# Setup the motor
+		self.motor = MotorController(self.motor_calibration)
+		self.jam = JamDetector(self.motor.params)
+		self.coins = CoinClassifier(self.motor.speed(self.motor.params['full']))
+		self.motor_off = self.motor.params['off']
+		self.motor_speed = self.motor_off
+
+		# Setup IR TX
+		self.set_led('ir', HIGH)
+
+		self.edges = self.hardware.edge_capture()
+		self.tags = self.hardware.tag_detector(self.rfid_irq, self.rfid_poll)
+
+		self.set_led('reader', HIGH)
+		self.coin_presences = collections.deque(maxlen=6)
+		self.payouts = collections.deque()
+
+	def close_hardware(self):
+		# Turnoff LEDs
+		for name in LEDS:
+			self.set_led(name, LOW)
+
+		self.edges.stop()
+		self.tags.stop()
+		self.hardware.close()
+
+	# Called when a jam is detected
+	def on_jam(self):
+		pass
+
+	# Called with the UID of every tag read
+	def on_tag(self, uid : str):
+		pass
+
+	# Called when a dispense finished with the amount dispensed and requested
+	def on_dispense_done(self, amount : int, requested : int, uid : str = None):
+		pass
+
+
+	def align_rotor(self):
+		logger.info('Aligning rotor')
+		self.is_calibrating = True
+		self.previous_edge_time = None
+		self.last_rotate_time = self.clock.now()
+		self.set_motor(self.motor.align())
+
+
+	def recovery_done(self):
+		if self.dispense_no > 0:
+			# Dispense the same amount
+			# But jump forward in the amount currently dispensed ;)
+			self.start_motor()
+		elif self.is_calibrating:
+			self.align_rotor()
+
+		self.is_recovery = False
+
+	# The timeout is measured from the last rotation, one late check sees it all
+	@Job(seconds = 1, align = True, overrun = 'coalesce')
+	def job_check_rotor_recovery(self):
+		# If we are calibrating, recovering or not dispensing, we are not doing anything
+		if self.motor_speed == self.motor_off:
+			return
+
+		if (self.clock.now() - self.last_rotate_time) > T_JAM and not self.is_recovery:
+			self.recover('timeout')
+
+	def recover(self, reason : str, ratio : float = None):
+		# Recovery mode
+		self.is_recovery = True
+		self.set_motor(self.motor.params['reverse'])
+		logger.error(f'Jam ({reason}) after {self.current_dispense_no} coins, recovering...')
+		self.jam.on_jam(reason, ratio, self.current_dispense_no)
+		JobOnce(self.recovery_done, seconds = 0.5)
+		self.on_jam()
+
+	# Every run drains the edge ring, so a late run adds nothing to the next one
+	@Job(milliseconds = 4, align = True, overrun = 'skip')
+	def job_check_rotor(self):
+		# Only the polling fallback samples here, interrupts fill the ring for us
+		self.edges.poll()
+
+		# We only check if we are aligning or dispensing
+		if self.dispense_no <= 0 and not self.is_calibrating and not self.is_recovery:
+			# Keep tracking the level without acting on it
+			for tick, ir_state in self.edges.drain():
+				if ir_state != self.previous_ir_state:
+					self.on_edge_passed()
+				self.previous_ir_state = ir_state
+			return
+
+		# Initialize
+		if self.previous_edge_time is None:
+			self.previous_edge_time = self.clock.now()
+
+		for tick, ir_state in self.edges.drain():
+			self.on_ir_edge(ir_state, tick)
+
+		# Catch a jam coming before T_JAM passes
+		if not self.is_recovery and self.motor_speed != self.motor_off:
+			tick = self.clock.now()
+			jam = self.jam.check(tick - self.last_rotate_time, tick - self.previous_edge_time, self.motor.speed(self.motor_speed))
+			if jam is not None:
+				self.recover(*jam)
+
+	def on_ir_edge(self, ir_state, tick):
+		# Detect raising edge
+		if self.previous_ir_state == 0 and ir_state == 1:
+			elapsed = tick - self.previous_edge_time
+			# logger.warn(f'Raising edge {elapsed}')
+			self.on_edge_width(tick, 0, elapsed)
+
+			self.previous_ir_state = 1
+			self.previous_edge_time = tick
+			self.on_edge_passed()
+
+			# Check for our alignment marker. A pocket has four edges, with less since
+			# the last one reversing carried it back past the sensor.
+			if (
+				not self.is_recovery and
+				(self.is_calibrating or self.marker_edges > 2) and
+				self.coins.is_marker(elapsed, self.motor.speed(self.motor_speed))
+				):
+				self.marker_edges = 0
+				self.marker_edges_seen = 0
+				self.on_half_rotation(not self.is_coin_empty)
+				self.is_coin_empty = False
+
+		# Detect trailing edge
+		elif self.previous_ir_state == 1 and ir_state == 0:
+			elapsed = tick - self.previous_edge_time
+			# logger.warn(f'Falling edge {elapsed}')
+			self.on_edge_width(tick, 1, elapsed)
+
+			self.previous_ir_state = 0
+			self.previous_edge_time = tick
+			is_new = self.on_edge_passed()
+
+			# If elapsed is in the slow window, the next coin will be empty. A pulse the
+			# motor stopped in would also count the time it stood still, one we passed
+			# before reversing was judged already.
+			width = min(elapsed, tick - self.motor_started_at)
+			if is_new and not self.is_recovery and self.coins.is_empty(width, self.motor.speed(self.motor_speed)):
+				self.is_coin_empty = True
+
+
+
+	# Edges since the marker, in recovery we are reversing so these count down.
+	# Returns if we passed this edge for the first time.
+	def on_edge_passed(self):
+		self.marker_edges += -1 if self.is_recovery else 1
+		if self.marker_edges <= self.marker_edges_seen:
+			return False
+		self.marker_edges_seen = self.marker_edges
+		return True
+
+	# Width of the pulse at level that just ended
+	def on_edge_width(self, tick, level, elapsed):
+		if not self.is_motor_starting and not self.is_recovery:
+			speed = self.motor.speed(self.motor_speed)
+			self.jam.on_edge(elapsed, speed)
+
+			# The rotor lags behind a new speed, so this width does not scale with it
+			if tick - elapsed >= self.motor_changed_at:
+				self.coins.push(tick, level, elapsed, speed)
+
+	def on_half_rotation(self, has_coin):
+		logger.info(f'Half rotation and coin presence is {has_coin}')
+
+		# The first half rotation includes starting the motor, it is no use as feedback
+		tick = self.clock.now()
+		period = 0 if self.is_motor_starting else tick - self.last_rotate_time
+		self.is_motor_starting = False
+		self.last_rotate_time = tick
+		self.jam.on_half_rotation(period, self.motor.speed(self.motor_speed))
+		self.coins.update()
+		self.coin_presences.append(has_coin)
+
+		if self.is_calibrating:
+			self.is_calibrating = False
+			self.set_motor(self.motor_off)
+			return
+
+		# If we are dispensing
+		if self.dispense_no > 0:
+			if has_coin:
+				self.empty_count = 0
+				self.current_dispense_no += 1
+				logger.info(f'Dispensed {self.current_dispense_no:d}')
+			else:
+				self.empty_count += 1
+				logger.info(f'Empty pocket {self.empty_count:d}')
+
+			if self.current_dispense_no >= self.dispense_no or self.empty_count >= self.motor.params['empty_rotations']:
+				self.dispense_done(self.current_dispense_no)
+
+			# Speed up or slow down for what is left, of the next payout when queued
+			if self.dispense_no > 0:
+				self.set_motor(self.motor.on_half_rotation(period, self.dispense_no - self.current_dispense_no))
+
+
+	# Taps last longer than a few runs and are queued by the detector
+	@Job(milliseconds = 20, overrun = 'skip')
+	def job_read_tag(self):
+		# Tags read during a payout are queued behind it
+		self.tags.poll()
+		for uid in self.tags.drain():
+			# We only use string UIDS padded to 14 digits
+			self.on_tag(f'{uid:014X}')
+
+
+	# Apply calibration parameters, see dispenser.motor.DEFAULTS
+	def configure_motor(self, params : dict):
+		is_off = self.motor_speed == self.motor_off
+		self.motor.configure(params)
+		self.motor_off = self.motor.params['off']
+		self.coins.full_speed = self.motor.speed(self.motor.params['full'])
+
+		if is_off and self.motor_speed != self.motor_off:
+			self.set_motor(self.motor_off)
+
+	def set_motor(self, speed: int):
+		if speed != self.motor_speed:
+			self.motor_changed_at = self.clock.now()
+		self.motor_speed = speed
+
+		# # We reverse a bit
+		# if speed == MOTOR_OFF:
+		# 	self.hardware.set_motor(MOTOR_REVERSE)
+		# 	time.sleep(0.3)
+
+		self.hardware.set_motor(speed)
+
+	def get_ir(self):
+		return self.hardware.read_ir()
+
+	def set_led(self, led : str, value):
+		if led not in LEDS:
+			raise ValueError(f'LED {led} does not exist')
+
+		logger.debug(f'Setting LED {led} to {value}')
+		self.hardware.set_led(led, value)
+
+	def dispense(self, amount : int, uid : str = None):
+		if amount <= 0:
+			return
+
+		# Wait for the running payout, we continue with this one without stopping
+		if self.dispense_no > 0:
+			self.payouts.append((uid, amount))
+			logger.info(f'Queued dispensing {amount:d}, {len(self.payouts)} waiting')
+			return
+
+		logger.info(f'Dispensing {amount:d}')
+		self.dispense_uid = uid
+		self.dispense_no = amount
+		self.current_dispense_no = 0
+		self.empty_count = 0
+		self.start_motor()
+
+	def start_motor(self):
+		self.previous_edge_time = None
+		self.last_rotate_time = self.clock.now()
+		self.motor_started_at = self.last_rotate_time
+		self.is_motor_starting = True
+
+		# Start the motor
+		self.set_motor(self.motor.start(self.dispense_no - self.current_dispense_no))
+		self.set_led('reader', LOW)
+		self.set_led('holder', HIGH)
+
+	# Whether a payout for this uid is running or queued
+	def is_dispensing(self, uid : str):
+		if self.dispense_no > 0 and self.dispense_uid == uid:
+			return True
+		return any(queued == uid for queued, _ in self.payouts)
+
+	def dispense_done(self, amount):
+		requested = self.dispense_no
+		uid = self.dispense_uid
+
+		if self.payouts and amount >= requested:
+			# Keep the motor going and count the next payout from here
+			self.dispense_uid, self.dispense_no = self.payouts.popleft()
+			self.current_dispense_no = 0
+			self.empty_count = 0
+			self.last_rotate_time = self.clock.now()
+			logger.info(f'Dispensing {self.dispense_no:d}, {len(self.payouts)} waiting')
+		else:
+			# Cleanup and turnoff the LED
+			self.set_motor(self.motor_off)
+			if amount > 0:
+				JobOnce(lambda: self.set_led('holder', LOW), runner = self, seconds = 3)
+				JobOnce(lambda: self.set_led('reader', HIGH), runner = self, seconds = 3)
+
+			# Our flag that we are not dispensing
+			self.dispense_no = 0
+			self.dispense_uid = None
+
+		self.on_dispense_done(amount, requested, uid)
+
+		# Without coins the queued payouts can not be paid either
+		if amount < requested:
+			while self.payouts:
+				queued_uid, queued = self.payouts.popleft()
+				self.on_dispense_done(0, queued, queued_uid)
+
+	def set_led_flash(self, led : str, amount : int, seconds : int, end_value : int, value : int = LOW):
+		self.set_led(led, value)
+		v = HIGH if value == LOW else LOW
+
+		if amount > 0:
+			JobOnce(partial(self.set_led_flash, led, amount - 1, seconds, end_value, v), seconds = seconds)
+		else:
+			JobOnce(partial(self.set_led, led, end_value), seconds = seconds)
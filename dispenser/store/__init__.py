@@ -0,0 +1,3 @@
+from dispenser.store.store import Store, Increment, DELETE_FIELD, SERVER_TIMESTAMP, StoreError, AlreadyExists, NotFound, InvalidArgument, PermissionDenied, FailedPrecondition, Unavailable, PERMANENT_ERRORS
+from dispenser.store.firestore import CREDENTIALS_PATH, FirestoreStore
+from dispenser.store.memory import MemoryStore
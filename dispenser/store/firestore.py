@@ -0,0 +1,69 @@
+import logging
+from dispenser.store import store
+from dispenser.store.store import Store, Increment, DELETE_FIELD, SERVER_TIMESTAMP
+
+logger = logging.getLogger(__name__)
+
+CREDENTIALS_PATH = '/boot/firebase-credentials.json'
+
+# Google Cloud Firestore, references and snapshots are the ones of the client
+class FirestoreStore(Store):
+	def __init__(self, credentials : str = CREDENTIALS_PATH):
+		from google.cloud import firestore
+		from google.api_core import exceptions
+
+		self.firestore = firestore
+		self.db = firestore.Client.from_service_account_json(credentials)
+
+		# Our errors for the ones of the client
+		self.errors = (
+			(exceptions.AlreadyExists, store.AlreadyExists),
+			(exceptions.NotFound, store.NotFound),
+			(exceptions.InvalidArgument, store.InvalidArgument),
+			(exceptions.PermissionDenied, store.PermissionDenied),
+			(exceptions.FailedPrecondition, store.FailedPrecondition),
+			(exceptions.ServiceUnavailable, store.Unavailable),
+		)
+
+	def collection(self, path : str):
+		return self.db.collection(path)
+
+	def batch(self):
+		return FirestoreBatch(self)
+
+	def close(self):
+		self.db.close()
+
+	def convert(self, value):
+		if isinstance(value, dict):
+			return {key: self.convert(value) for key, value in value.items()}
+		if isinstance(value, Increment):
+			return self.firestore.Increment(value.value)
+		if value is DELETE_FIELD:
+			return self.firestore.DELETE_FIELD
+		if value is SERVER_TIMESTAMP:
+			return self.firestore.SERVER_TIMESTAMP
+		return value
+
+class FirestoreBatch():
+	def __init__(self, store : FirestoreStore):
+		self.store = store
+		self.batch = store.db.batch()
+
+	def create(self, ref, data : dict):
+		self.batch.create(ref, self.store.convert(data))
+
+	def set(self, ref, data : dict, merge : bool = False):
+		self.batch.set(ref, self.store.convert(data), merge = merge)
+
+	def update(self, ref, data : dict):
+		self.batch.update(ref, self.store.convert(data))
+
+	def commit(self):
+		try:
+			return self.batch.commit()
+		except Exception as e:
+			for error, translated in self.store.errors:
+				if isinstance(e, error):
+					raise translated(str(e)) from e
+			raise
@@ -0,0 +1,367 @@
+import copy
+import enum
+import time
+import heapq
+import random
+import logging
+import threading
+import collections
+from datetime import datetime, timedelta, timezone
+from dispenser.store.store import Store, Increment, DELETE_FIELD, SERVER_TIMESTAMP, AlreadyExists, NotFound, InvalidArgument, Unavailable
+
+logger = logging.getLogger(__name__)
+
+# Firestore sustains about one write per second to a single document, writes
+# closer together than this count as contended
+CONTENTION_WINDOW = 1
+
+class ChangeType(enum.Enum):
+	ADDED = 1
+	MODIFIED = 2
+	REMOVED = 3
+
+class DocumentSnapshot():
+	def __init__(self, reference, data : dict, create_time : datetime, update_time : datetime, read_time : datetime):
+		self.reference = reference
+		self.id = reference.id
+		self.exists = data is not None
+		self.create_time = create_time
+		self.update_time = update_time
+		self.read_time = read_time
+		self._data = data
+
+	def to_dict(self):
+		return copy.deepcopy(self._data)
+
+	def get(self, field : str):
+		value = self._data
+		for part in field.split('.'):
+			value = value[part]
+		return copy.deepcopy(value)
+
+class DocumentChange():
+	def __init__(self, type : ChangeType, document : DocumentSnapshot, old_index : int, new_index : int):
+		self.type = type
+		self.document = document
+		self.old_index = old_index
+		self.new_index = new_index
+
+class MemoryCollection():
+	def __init__(self, store, path : str):
+		self.store = store
+		self.path = path
+		self.id = path.rsplit('/', 1)[-1]
+
+	def document(self, id : str):
+		return MemoryDocument(self.store, f'{self.path}/{id}')
+
+	def on_snapshot(self, callback):
+		return self.store.watch(self, callback)
+
+	def contains(self, path : str):
+		return path.rsplit('/', 1)[0] == self.path
+
+class MemoryDocument():
+	def __init__(self, store, path : str):
+		self.store = store
+		self.path = path
+		self.id = path.rsplit('/', 1)[-1]
+
+	def collection(self, id : str):
+		return MemoryCollection(self.store, f'{self.path}/{id}')
+
+	def get(self):
+		return self.store.snapshot(self, self.store.timestamp())
+
+	def on_snapshot(self, callback):
+		return self.store.watch(self, callback)
+
+	def contains(self, path : str):
+		return path == self.path
+
+	def __eq__(self, other):
+		return isinstance(other, MemoryDocument) and other.path == self.path
+
+	def __hash__(self):
+		return hash(self.path)
+
+class Watch():
+	def __init__(self, store, ref, callback):
+		self.store = store
+		self.ref = ref
+		self.callback = callback
+		self._closed = False
+
+		# Update time of every document we reported, in the order we reported them
+		self.known = {}
+		self.is_initial = True
+
+	def unsubscribe(self):
+		self.store.unwatch(self)
+
+# Resolve the special values of a write into the data of a document
+def merge(data : dict, new : dict, now : datetime, is_merge : bool = True):
+	for key, value in new.items():
+		previous = data.get(key)
+
+		if value is DELETE_FIELD:
+			if not is_merge:
+				raise InvalidArgument(f'DELETE_FIELD can only be used when merging, not for {key}')
+			data.pop(key, None)
+		elif isinstance(value, dict):
+			if not is_merge or not isinstance(previous, dict):
+				previous = data[key] = {}
+			merge(previous, value, now, is_merge)
+		else:
+			data[key] = resolve(value, previous, now)
+	return data
+
+def resolve(value, previous, now : datetime):
+	if isinstance(value, Increment):
+		if isinstance(previous, (int, float)) and not isinstance(previous, bool):
+			return previous + value.value
+		return value.value
+	if value is SERVER_TIMESTAMP:
+		return now
+	if isinstance(value, dict):
+		return merge({}, value, now, is_merge = False)
+	return copy.deepcopy(value)
+
+def update(data : dict, fields : dict, now : datetime):
+	for path, value in fields.items():
+		parts = path.split('.')
+		parent = data
+		for part in parts[:-1]:
+			if not isinstance(parent.get(part), dict):
+				parent[part] = {}
+			parent = parent[part]
+
+		if value is DELETE_FIELD:
+			parent.pop(parts[-1], None)
+		else:
+			parent[parts[-1]] = resolve(value, parent.get(parts[-1]), now)
+	return data
+
+# In process store with the semantics of Firestore, for running without network.
+#
+# Commits and snapshots are delayed by latency (seconds, or a (low, high) range)
+# and commits fail with Unavailable at failure_rate. With lost_rate a commit is
+# applied but still fails, as when the reply never reaches us. outage takes the
+# store offline for a while, closing every watch.
+class MemoryStore(Store):
+	def __init__(self, latency = 0, failure_rate : float = 0, lost_rate : float = 0, seed : int = None):
+		self.latency = latency
+		self.failure_rate = failure_rate
+		self.lost_rate = lost_rate
+		self.random = random.Random(seed)
+
+		self.condition = threading.Condition()
+		self.documents = {}
+		self.watches = []
+		self.offline_until = 0
+		self.last_time = None
+		self.stats = collections.Counter()
+
+		# Writes and contended writes per document path, watches notified per commit
+		self.document_writes = collections.Counter()
+		self.document_contention = collections.Counter()
+		self.last_writes = {}
+		self.fanout = collections.Counter()
+
+		# Snapshot deliveries as (monotonic time, sequence, watch)
+		self.deliveries = []
+		self.sequence = 0
+		self.is_closed = False
+		self.thread = threading.Thread(target = self.run, name = 'store', daemon = True)
+		self.thread.start()
+
+	def collection(self, path : str):
+		return MemoryCollection(self, path)
+
+	def batch(self):
+		return MemoryBatch(self)
+
+	def close(self):
+		with self.condition:
+			self.is_closed = True
+			self.condition.notify()
+		self.thread.join()
+
+	def delay(self):
+		if isinstance(self.latency, (tuple, list)):
+			return self.random.uniform(*self.latency)
+		return self.latency
+
+	@property
+	def is_online(self):
+		return time.monotonic() >= self.offline_until
+
+	def outage(self, seconds : float):
+		with self.condition:
+			self.offline_until = max(self.offline_until, time.monotonic() + seconds)
+			for watch in self.watches:
+				watch._closed = True
+			self.watches.clear()
+			self.stats['outages'] += 1
+		logger.warning(f'Store offline for {seconds:.1f}s')
+
+	# Unique and increasing, like the update times of Firestore
+	def timestamp(self):
+		now = datetime.now(timezone.utc)
+		if self.last_time is not None and now <= self.last_time:
+			now = self.last_time + timedelta(microseconds = 1)
+		self.last_time = now
+		return now
+
+	def snapshot(self, ref, read_time : datetime):
+		document = self.documents.get(ref.path)
+		if document is None:
+			return DocumentSnapshot(ref, None, None, None, read_time)
+		return DocumentSnapshot(ref, document['data'], document['create_time'], document['update_time'], read_time)
+
+	def commit(self, writes : list):
+		time.sleep(self.delay())
+
+		with self.condition:
+			self.stats['commits'] += 1
+			if not self.is_online or self.random.random() < self.failure_rate:
+				self.stats['failures'] += 1
+				raise Unavailable('Injected failure')
+
+			# All or nothing, so apply to copies first
+			now = self.timestamp()
+			changed = {}
+			for op, ref, data in writes:
+				document = changed.get(ref.path, self.documents.get(ref.path))
+				if op == 'create' and document is not None:
+					raise AlreadyExists(f'Document already exists: {ref.path}')
+				if op == 'update' and document is None:
+					raise NotFound(f'No document to update: {ref.path}')
+
+				if op == 'update':
+					fields = update(copy.deepcopy(document['data']), data, now)
+				elif op == 'set' and document is not None:
+					fields = merge(copy.deepcopy(document['data']), data, now)
+				else:
+					fields = merge({}, data, now, is_merge = op == 'set')
+
+				changed[ref.path] = {
+					'data': fields,
+					'create_time': now if document is None else document['create_time'],
+					'update_time': now,
+				}
+
+			self.documents.update(changed)
+			self.stats['writes'] += len(writes)
+
+			at = time.monotonic()
+			for path in changed:
+				self.document_writes[path] += 1
+				if at - self.last_writes.get(path, -CONTENTION_WINDOW) < CONTENTION_WINDOW:
+					self.document_contention[path] += 1
+					self.stats['contended'] += 1
+				self.last_writes[path] = at
+
+			# Tell everyone watching any of these documents
+			notified = 0
+			for watch in self.watches:
+				if any(watch.ref.contains(path) for path in changed):
+					self.__deliver(watch)
+					notified += 1
+			self.fanout[notified] += 1
+
+			if self.random.random() < self.lost_rate:
+				self.stats['lost'] += 1
+				raise Unavailable('Injected lost reply')
+			return now
+
+	def watch(self, ref, callback):
+		with self.condition:
+			watch = Watch(self, ref, callback)
+			self.watches.append(watch)
+			self.__deliver(watch)
+			return watch
+
+	def unwatch(self, watch : Watch):
+		with self.condition:
+			watch._closed = True
+			if watch in self.watches:
+				self.watches.remove(watch)
+
+	def __deliver(self, watch : Watch):
+		self.sequence += 1
+		heapq.heappush(self.deliveries, (max(time.monotonic(), self.offline_until) + self.delay(), self.sequence, watch))
+		self.condition.notify()
+
+	# Changes since the last snapshot of a watch, None when there are none
+	def __changes(self, watch : Watch, read_time : datetime):
+		paths = sorted(path for path in self.documents if watch.ref.contains(path))
+		docs = [self.snapshot(MemoryDocument(self, path), read_time) for path in paths]
+
+		changes = []
+		for i, doc in enumerate(docs):
+			path = doc.reference.path
+			if path not in watch.known:
+				changes.append(DocumentChange(ChangeType.ADDED, doc, -1, i))
+			elif watch.known[path] != doc.update_time:
+				changes.append(DocumentChange(ChangeType.MODIFIED, doc, list(watch.known).index(path), i))
+
+		known = list(watch.known)
+		for path in watch.known.keys() - set(paths):
+			changes.append(DocumentChange(ChangeType.REMOVED, self.snapshot(MemoryDocument(self, path), read_time), known.index(path), -1))
+
+		if not changes and not watch.is_initial:
+			return None, None
+
+		watch.is_initial = False
+		watch.known = {doc.reference.path: doc.update_time for doc in docs}
+		return docs, changes
+
+	def run(self):
+		with self.condition:
+			while not self.is_closed:
+				if not self.deliveries:
+					self.condition.wait()
+					continue
+
+				due, _, watch = self.deliveries[0]
+				if due > time.monotonic():
+					self.condition.wait(due - time.monotonic())
+					continue
+				heapq.heappop(self.deliveries)
+
+				if watch._closed:
+					continue
+
+				read_time = self.timestamp()
+				docs, changes = self.__changes(watch, read_time)
+				if docs is None:
+					continue
+				self.stats['snapshots'] += 1
+				self.stats['changes'] += len(changes)
+
+				# Callbacks may write to the store themselves
+				self.condition.release()
+				try:
+					watch.callback(docs, changes, read_time)
+				except Exception:
+					logger.exception('Exception in snapshot callback')
+				finally:
+					self.condition.acquire()
+
+class MemoryBatch():
+	def __init__(self, store : MemoryStore):
+		self.store = store
+		self.writes = []
+
+	def create(self, ref, data : dict):
+		self.writes.append(('create', ref, copy.deepcopy(data)))
+
+	def set(self, ref, data : dict, merge : bool = False):
+		self.writes.append(('set' if merge else 'replace', ref, copy.deepcopy(data)))
+
+	def update(self, ref, data : dict):
+		self.writes.append(('update', ref, copy.deepcopy(data)))
+
+	def commit(self):
+		return self.store.commit(self.writes)
@@ -0,0 +1,87 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Field values with a meaning to the store, every backend translates these
+class Increment():
+	__slots__ = ('value',)
+
+	def __init__(self, value):
+		self.value = value
+
+	def __eq__(self, other):
+		return isinstance(other, Increment) and other.value == self.value
+
+	def __repr__(self):
+		return f'Increment({self.value})'
+
+class Sentinel():
+	__slots__ = ('name',)
+
+	def __init__(self, name : str):
+		self.name = name
+
+	# There is only one of each
+	def __copy__(self):
+		return self
+
+	def __deepcopy__(self, memo):
+		return self
+
+	def __repr__(self):
+		return self.name
+
+DELETE_FIELD = Sentinel('DELETE_FIELD')
+SERVER_TIMESTAMP = Sentinel('SERVER_TIMESTAMP')
+
+# Errors of a commit, anything else is treated as temporary
+class StoreError(Exception):
+	pass
+
+class AlreadyExists(StoreError):
+	pass
+
+class NotFound(StoreError):
+	pass
+
+class InvalidArgument(StoreError):
+	pass
+
+class PermissionDenied(StoreError):
+	pass
+
+class FailedPrecondition(StoreError):
+	pass
+
+class Unavailable(StoreError):
+	pass
+
+# Errors that will not go away by retrying the same write
+PERMANENT_ERRORS = (
+	NotFound,
+	InvalidArgument,
+	PermissionDenied,
+	FailedPrecondition,
+)
+
+# The documents a dispenser uses. References have a path, document and
+# collection, and on_snapshot with the Firestore callback signature. Batches
+# have create, set, update and commit.
+class Store():
+	def collection(self, path : str):
+		raise NotImplementedError
+
+	def batch(self):
+		raise NotImplementedError
+
+	def close(self):
+		pass
+
+	def area(self, area : str):
+		return self.collection('areas').document(area)
+
+	def players(self):
+		return self.collection('players')
+
+	def player(self, uid : str):
+		return self.players().document(uid)
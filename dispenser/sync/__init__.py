@@ -0,0 +1,2 @@
+from dispenser.sync.sync import Sync
+from dispenser.sync.journal import Journal, CHECKIN, CHECKOUT, TICK, DISPENSE, EMPTY
@@ -0,0 +1,221 @@
+import os
+import time
+import zlib
+import struct
+import logging
+import threading
+from dispenser.job import get_clock
+
+logger = logging.getLogger(__name__)
+
+MAGIC = 0xD15E
+
+# magic, type, flags, seq, time (ns since epoch), value, uid, text length
+HEADER = struct.Struct('<HBBIqi7sB')
+CRC = struct.Struct('<I')
+
+# Event types
+CHECKIN = 1
+CHECKOUT = 2
+TICK = 3
+DISPENSE = 4
+ACK = 255
+
+# Event flags
+EMPTY = 1
+
+class Journal():
+	def __init__(self, path : str, size : int = 1 << 20, interval : float = 0.2):
+		self.path = path
+		self.size = size
+		self.interval = interval
+
+		self.lock = threading.Lock()
+		self.condition = threading.Condition(self.lock)
+		self.entries = {}
+		self.seq = 0
+		self.offset = 0
+		self.is_dirty = False
+		self.is_full = False
+		self.is_closed = False
+
+		self.fd = self.__open()
+		self.thread = threading.Thread(target = self.run, name = 'journal', daemon = True)
+		self.thread.start()
+
+	def __open(self):
+		os.makedirs(os.path.dirname(self.path) or '.', exist_ok = True)
+		fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+
+		# Read back everything that is still valid
+		acked = set()
+		data = os.pread(fd, max(self.size, os.fstat(fd).st_size), 0)
+		while True:
+			entry = self.__decode(data, self.offset)
+			if entry is None:
+				break
+
+			self.offset += HEADER.size + len(entry['text'].encode()) + CRC.size
+			self.seq = max(self.seq, entry['seq'])
+			if entry['type'] == ACK:
+				acked.add(entry['value'])
+			else:
+				self.entries[entry['seq']] = entry
+
+		for seq in acked:
+			self.entries.pop(seq, None)
+
+		# Preallocate so appending never has to grow the file
+		self.size = max(self.size, len(data))
+		os.posix_fallocate(fd, 0, self.size)
+
+		if len(self.entries) > 0:
+			logger.info(f'Journal has {len(self.entries)} pending entries')
+		return fd
+
+	def __decode(self, data, offset):
+		if offset + HEADER.size + CRC.size > len(data):
+			return None
+
+		magic, type, flags, seq, at, value, uid, length = HEADER.unpack_from(data, offset)
+		end = offset + HEADER.size + length
+		if magic != MAGIC or end + CRC.size > len(data):
+			return None
+
+		# A torn write at the end of the journal fails the checksum
+		if zlib.crc32(data[offset:end]) != CRC.unpack_from(data, end)[0]:
+			return None
+
+		return self.__entry(type, flags, seq, at, value, uid.hex().upper() if any(uid) else '', data[offset + HEADER.size:end].decode())
+
+	def __entry(self, type, flags, seq, at, value, uid, text):
+		return {
+			'type': type,
+			'flags': flags,
+			'seq': seq,
+			'time': at,
+			'value': value,
+			'uid': uid,
+			'text': text,
+			# Stable across replays and compactions
+			'key': f'{at:016x}-{seq:08x}',
+		}
+
+	def __encode(self, entry):
+		text = entry['text'].encode()
+		uid = bytes.fromhex(entry['uid']) if entry['uid'] else bytes(7)
+		record = HEADER.pack(MAGIC, entry['type'], entry['flags'], entry['seq'], entry['time'], entry['value'], uid, len(text)) + text
+		return record + CRC.pack(zlib.crc32(record))
+
+	def __write(self, record):
+		os.pwrite(self.fd, record, self.offset)
+		self.offset += len(record)
+		self.is_dirty = True
+
+		# The journal thread compacts before we run out of room, should it not keep
+		# up the file grows past its preallocated size
+		if self.offset > self.size * 3 // 4:
+			self.is_full = True
+		self.condition.notify()
+
+	def __compact(self):
+		# Rewrite only the pending entries into a fresh file, without the lock so
+		# appends carry on in the old one
+		self.is_full = False
+		entries = list(self.entries.values())
+		mark = self.offset
+
+		path = self.path + '.tmp'
+		self.lock.release()
+		try:
+			records = b''.join(self.__encode(entry) for entry in entries)
+			size = self.size
+			while len(records) > size // 2:
+				size *= 2
+
+			fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+			try:
+				os.posix_fallocate(fd, 0, size)
+				os.pwrite(fd, records, 0)
+				os.fdatasync(fd)
+			except OSError:
+				os.close(fd)
+				raise
+		finally:
+			self.lock.acquire()
+
+		# Copy over what was appended meanwhile, the next sync covers it
+		tail = os.pread(self.fd, self.offset - mark, mark)
+		os.pwrite(fd, tail, len(records))
+		os.replace(path, self.path)
+		os.close(self.fd)
+		self.fd = fd
+		self.size = size
+		self.offset = len(records) + len(tail)
+		self.is_dirty = self.is_dirty or len(tail) > 0
+		logger.info(f'Compacted journal to {len(self.entries)} entries')
+
+		# Make sure the rename itself is durable
+		self.lock.release()
+		try:
+			directory = os.open(os.path.dirname(self.path) or '.', os.O_RDONLY)
+			try:
+				os.fsync(directory)
+			finally:
+				os.close(directory)
+		finally:
+			self.lock.acquire()
+
+	def append(self, type : int, uid : str = '', value : int = 0, flags : int = 0, text : str = '', at : int = None):
+		with self.lock:
+			self.seq += 1
+			entry = self.__entry(type, flags, self.seq, get_clock().time() if at is None else at, value, uid, text)
+			self.__write(self.__encode(entry))
+			self.entries[entry['seq']] = entry
+			return entry
+
+	def ack(self, seq : int):
+		with self.lock:
+			if self.entries.pop(seq, None) is None:
+				return
+			self.__write(self.__encode(self.__entry(ACK, 0, 0, 0, seq, '', '')))
+
+	def pending(self):
+		with self.lock:
+			return list(self.entries.values())
+
+	def close(self):
+		with self.lock:
+			self.is_closed = True
+			self.condition.notify()
+		self.thread.join()
+		os.close(self.fd)
+
+	def run(self):
+		# Group commit, a single fdatasync covers everything written in an interval
+		with self.lock:
+			while not self.is_closed or self.is_dirty:
+				if self.is_full and not self.is_closed:
+					try:
+						self.__compact()
+					except OSError:
+						logger.exception('Unable to compact journal')
+
+				if not self.is_dirty:
+					self.condition.wait()
+					continue
+
+				self.is_dirty = False
+				fd = self.fd
+				self.lock.release()
+				try:
+					os.fdatasync(fd)
+				except OSError:
+					logger.exception('Unable to sync journal')
+				finally:
+					self.lock.acquire()
+
+				# Appends notify us, but we only sync once per interval
+				deadline = time.monotonic() + self.interval
+				while not self.is_closed and time.monotonic() < deadline:
+					self.condition.wait(deadline - time.monotonic())
@@ -0,0 +1,225 @@
+import time
+import random
+import logging
+import threading
+from dispenser import metrics
+from dispenser.store import Increment, AlreadyExists, PERMANENT_ERRORS
+
+logger = logging.getLogger(__name__)
+
+# Firestore does not accept more writes in a single batch
+MAX_BATCH = 500
+
+def is_increment(value):
+	return isinstance(value, Increment)
+
+def copy(data):
+	return {key: copy(value) if isinstance(value, dict) else value for key, value in data.items()}
+
+def merge(old, new):
+	for key, value in new.items():
+		previous = old.get(key)
+
+		if isinstance(value, dict) and isinstance(previous, dict):
+			merge(previous, value)
+		elif is_increment(value) and is_increment(previous):
+			old[key] = Increment(previous.value + value.value)
+		elif is_increment(value) and isinstance(previous, (int, float)) and not isinstance(previous, bool):
+			old[key] = previous + value.value
+		else:
+			old[key] = copy(value) if isinstance(value, dict) else value
+
+class Sync():
+	def __init__(self, store, linger : float = 0.05, backoff : float = 0.5, max_backoff : float = 60):
+		self.store = store
+		self.linger = linger
+		self.backoff = backoff
+		self.max_backoff = max_backoff
+
+		self.condition = threading.Condition()
+		self.pending = []
+		self.last = {}
+		self.attempt = 0
+		self.retry_at = 0
+		self.is_closed = False
+		self.thread = None
+
+	def start(self):
+		self.thread = threading.Thread(target = self.run, name = 'sync', daemon = True)
+		self.thread.start()
+
+	def close(self, timeout : float = 5):
+		with self.condition:
+			self.is_closed = True
+			self.condition.notify()
+
+		if self.thread is not None:
+			self.thread.join(timeout)
+			if self.thread.is_alive():
+				logger.error(f'Closing sync with {len(self.pending)} writes pending')
+
+	def set(self, ref, data, merge = False):
+		self.__add(ref, 'set' if merge else 'replace', data)
+
+	def update(self, ref, data):
+		self.__add(ref, 'update', data)
+
+	# Commit writes atomically together with creating the marker document. When the
+	# marker already exists the writes were applied before and are skipped. The
+	# callback is called with whether the writes are (or already were) applied.
+	def event(self, marker, data, writes, callback = None):
+		with self.condition:
+			self.pending.append({
+				'ref': marker,
+				'op': 'event',
+				'data': copy(data),
+				'writes': [(ref, op, copy(data)) for ref, op, data in writes],
+				'callback': callback,
+			})
+
+			# Later writes may not be merged into writes before this event
+			self.last.clear()
+			self.condition.notify()
+
+	def __add(self, ref, op, data):
+		with self.condition:
+			last = self.last.get(ref.path)
+
+			# Merge into the pending write to the same document when possible.
+			# Field paths of an update are flat, so updates only merge with updates.
+			if last is not None and op != 'replace' and (last['op'] == 'update') == (op == 'update'):
+				merge(last['data'], data)
+				return
+
+			mutation = {
+				'ref': ref,
+				'op': op,
+				'data': copy(data),
+			}
+			self.pending.append(mutation)
+			self.last[ref.path] = mutation
+			self.condition.notify()
+
+	def __take(self):
+		# Batch as much as fits, an event takes its marker and all its writes
+		count = 0
+		size = 0
+		while count < len(self.pending):
+			mutation = self.pending[count]
+			writes = 1 + len(mutation.get('writes', ()))
+			if count > 0 and size + writes > MAX_BATCH:
+				break
+			size += writes
+			count += 1
+
+		mutations = self.pending[:count]
+		del self.pending[:count]
+
+		# Taken writes can no longer be merged into
+		for mutation in mutations:
+			if self.last.get(mutation['ref'].path) is mutation:
+				del self.last[mutation['ref'].path]
+
+		return mutations
+
+	def __commit(self, mutations):
+		batch = self.store.batch()
+		for mutation in mutations:
+			if mutation['op'] == 'event':
+				batch.create(mutation['ref'], mutation['data'])
+				for ref, op, data in mutation['writes']:
+					self.__write(batch, ref, op, data)
+			else:
+				self.__write(batch, mutation['ref'], mutation['op'], mutation['data'])
+
+		start = time.perf_counter_ns()
+		try:
+			batch.commit()
+			metrics.FIRESTORE_COMMIT.labels(result = 'ok').record(time.perf_counter_ns() - start)
+			metrics.FIRESTORE_WRITES.labels().inc(len(mutations))
+		except AlreadyExists:
+			metrics.FIRESTORE_COMMIT.labels(result = 'exists').record(time.perf_counter_ns() - start)
+			# Only events create documents, so this event was applied before. With
+			# more in the batch we do not know which one, see __commit_each
+			if len(mutations) != 1 or mutations[0]['op'] != 'event':
+				raise
+			logger.info(f'Skipping already applied {mutations[0]["ref"].path}')
+		except Exception:
+			metrics.FIRESTORE_COMMIT.labels(result = 'error').record(time.perf_counter_ns() - start)
+			raise
+
+		self.__done(mutations, True)
+
+	def __write(self, batch, ref, op, data):
+		if op == 'update':
+			batch.update(ref, data)
+		else:
+			batch.set(ref, data, merge = op == 'set')
+
+	def __done(self, mutations, is_applied):
+		for mutation in mutations:
+			if mutation.get('callback') is not None:
+				try:
+					mutation['callback'](is_applied)
+				except Exception:
+					logger.exception('Exception in write callback')
+
+	def __commit_each(self, mutations):
+		# Find the offending writes by committing one by one
+		for i, mutation in enumerate(mutations):
+			try:
+				self.__commit([mutation])
+			except PERMANENT_ERRORS:
+				logger.exception(f'Dropping write to {mutation["ref"].path}')
+				self.__done([mutation], False)
+			except Exception:
+				self.__retry(mutations[i:])
+				return
+
+	def __retry(self, mutations):
+		with self.condition:
+			# Put them back in front, in their original order
+			self.pending[:0] = mutations
+
+			delay = min(self.max_backoff, self.backoff * 2 ** self.attempt)
+			delay *= 0.5 + random.random() / 2
+			self.attempt += 1
+			self.retry_at = time.monotonic() + delay
+			logger.warning(f'Retrying {len(self.pending)} writes in {delay:.1f}s')
+
+	def __wait(self, deadline = None):
+		# New writes notify us, so keep waiting until the deadline passed
+		while not self.is_closed:
+			if deadline is None:
+				if self.pending:
+					return
+				self.condition.wait()
+			else:
+				timeout = deadline - time.monotonic()
+				if timeout <= 0:
+					return
+				self.condition.wait(timeout)
+
+	def run(self):
+		while True:
+			with self.condition:
+				self.__wait()
+				if not self.pending:
+					return
+
+				# Back off after failures and give a burst of writes some time to coalesce
+				self.__wait(max(self.retry_at, time.monotonic() + self.linger))
+				mutations = self.__take()
+
+			try:
+				self.__commit(mutations)
+				self.attempt = 0
+			except (AlreadyExists, *PERMANENT_ERRORS):
+				self.__commit_each(mutations)
+			except Exception:
+				logger.exception('Unable to commit writes')
+				self.__retry(mutations)
+
+			# Do not keep retrying forever when closing
+			if self.is_closed and self.attempt > 3:
+				return
@@ -1,4 +1,5 @@
 import dispenser
 import argparse
 
-dispenser.main()
+if __name__ == '__main__':
+	dispenser.main()
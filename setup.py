@@ -16,6 +16,7 @@ setuptools.setup(
 	long_description_content_type = 'text/markdown',
 	url                           = 'https://github.com/kevinvalk/python-dispenser',
 	packages                      = setuptools.find_packages(),
+	python_requires               = '>=3.8',
 	install_requires              = [
 		'wiringpi',
 		'firebase-admin',
@@ -36,6 +37,8 @@ setuptools.setup(
 	entry_points                  = {
 		'console_scripts': [
 			'dispenser = dispenser:main',
+			'dispenser-loadtest = dispenser.loadtest:main',
+			'dispenser-benchmark = dispenser.job.benchmark:main',
 		]
 	},
 )